@@ -1,15 +1,27 @@
 from mitmproxy import http
+from mitmproxy.connection import ConnectionState
+import asyncio
 import html as html_lib
+import httpx
+import json
 import os
 import time
+import weakref
+import zlib
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
-from bs4 import BeautifulSoup, Comment
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from bs4 import BeautifulSoup
+from bs4.builder import HTMLTreeBuilder
+from html.parser import HTMLParser
 from urllib.parse import urljoin, quote, urlsplit
 import markdown
 import nh3
 import re
 import bs4
+from darkly_admission import (PRIORITY_BACKGROUND, PRIORITY_DOCUMENT, Priority, ProviderGate,
+                              priority_for_dest)
+from darkly_cache import ResultCache, cache_key
+from darkly_router import Router
 
 load_dotenv()
 
@@ -93,106 +105,923 @@ def sanitize_html(value):
     )
 
 
-def dom_to_condensed(html_content):
-    soup = BeautifulSoup(html_content, 'html.parser')
-    for tag in soup(['script', 'style', 'noscript', 'svg', 'canvas', 'video', 'audio', 'iframe', 'button', 'input', 'form', 'select', 'textarea']):
-        tag.decompose()
-    for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
-        comment.extract()
-
-    mapping = {}
-    next_id = 1
-    block_tags = {'div', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'article', 'section', 'header', 'footer', 'nav', 'main', 'aside', 'figure', 'ul', 'ol', 'table', 'tr', 'td', 'th'}
-
-    def process_node(node):
-        nonlocal next_id
-        if node.name == 'a':
-            href = node.get('href')
-            if href:
-                id_val = next_id; next_id += 1
-                mapping[id_val] = {'type': 'a', 'href': href}
-                text = "".join(process_node(c) for c in node.children)
-                # Link text must stay on one line or the [text][id] reference breaks.
-                text = clean_inline(text).strip()
-                if text: return f"[{text}][{id_val}]"
-            return ""
-        elif node.name == 'img':
-            src = node.get('src')
+# Which BeautifulSoup tree builder dom_to_condensed uses. "lxml" parses several
+# times faster on large pages but needs the optional lxml package, and builds a
+# different tree from html.parser for some malformed markup -- so the condensed
+# text is only guaranteed identical to the default for well-formed pages.
+HTML_PARSER = os.getenv("DARKLY_HTML_PARSER", "html.parser")
+
+SKIP_TAGS = frozenset({'script', 'style', 'noscript', 'svg', 'canvas', 'video', 'audio', 'iframe', 'button', 'input', 'form', 'select', 'textarea'})
+BLOCK_TAGS = frozenset({'div', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'article', 'section', 'header', 'footer', 'nav', 'main', 'aside', 'figure', 'ul', 'ol', 'table', 'tr', 'td', 'th'})
+HINT_TAGS = ('nav', 'header', 'footer', 'aside')
+HINT_CLASSES = ('ad', 'sponsor', 'nav', 'menu', 'sidebar', 'footer', 'header', 'promo')
+# Text inside these is not plain page text (bs4 gives it its own string class).
+STRING_CONTAINER_TAGS = frozenset({'rt', 'rp', 'template'})
+VOID_TAGS = frozenset(HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS)
+
+_HSPACE_RE = re.compile(r'[^\S\n]+')
+ID_REF_RE = re.compile(r'\]\[(\d+)\]')
+# Density-based boilerplate removal (see _drop_boilerplate). Off by default:
+# compare the "kept" column of darkly_compare.py with it on and off.
+BOILERPLATE_FILTER = os.getenv("DARKLY_BOILERPLATE_FILTER", "").lower() in ("1", "true", "yes")
+MAIN_CONTENT_SHARE = 0.6
+LINK_DENSITY_LIMIT = 0.5
+# Rough average for English text. Only used to turn token budgets into
+# character counts, so budgets are approximate.
+CHARS_PER_TOKEN = 4
+
+
+def _block_hint(name, classes):
+    hint = ""
+    if name in HINT_TAGS:
+        hint = f"({name.upper()}) "
+    if classes:
+        classes_str = " ".join(classes).lower()
+        if any(bad in classes_str for bad in HINT_CLASSES):
+            hint = f"({name.upper()} hint:{' '.join(classes)}) "
+    return hint
+
+
+def _hint_tier(hint):
+    """How expendable a hinted block is: 2 class-matched (ads, menus), 1 nav/header/footer/aside, 0 content."""
+    if "hint:" in hint:
+        return 2
+    return 1 if hint else 0
+
+
+def _fit_budget(lines, tiers, token_budget):
+    """Which lines to keep so the text fits token_budget, as a list of bools.
+
+    Whole lines are dropped, most expendable first: everything under a
+    class-hinted block, then nav/header/footer/aside blocks, then main content
+    from the bottom of the page up.
+    """
+    keep = [True] * len(lines)
+    max_chars = token_budget * CHARS_PER_TOKEN
+    total = sum(len(line) + 1 for line in lines)
+    if total <= max_chars:
+        return keep
+    original = total
+    for i in sorted(range(len(lines)), key=lambda i: (-tiers[i], -i)):
+        if total <= max_chars:
+            break
+        keep[i] = False
+        total -= len(lines[i]) + 1
+    print(f"Token budget {token_budget}: cut {original - total} of {original} chars "
+          f"({keep.count(False)} of {len(lines)} blocks)")
+    return keep
+
+
+def _drop_boilerplate(lines, owners, blocks):
+    """Which lines survive density-based boilerplate removal, as a list of bools.
+
+    The main content is the deepest block that still holds MAIN_CONTENT_SHARE
+    of the page's non-link text. Outside it, any block whose text is mostly
+    link text (nav bars, link farms, related-article rails) is dropped whole.
+    Nothing inside the main content is touched, so a page that is all links
+    (a front page) keeps them.
+    """
+    keep = [True] * len(lines)
+    page_text = blocks[0].text_chars
+    if not page_text:
+        return keep
+    main = 0
+    for i, block in enumerate(blocks):
+        if block.text_chars >= MAIN_CONTENT_SHARE * page_text and block.depth > blocks[main].depth:
+            main = i
+    around_main = set()
+    i = main
+    while i:
+        around_main.add(i)
+        i = blocks[i].parent
+    inside = [False] * len(blocks)
+    dropped = [False] * len(blocks)
+    inside[main] = True
+    for i in range(1, len(blocks)):  # parents always come before children
+        block = blocks[i]
+        if inside[block.parent]:
+            inside[i] = True
+        elif dropped[block.parent]:
+            dropped[i] = True
+        elif i not in around_main and block.links:
+            dropped[i] = block.link_chars >= LINK_DENSITY_LIMIT * (block.link_chars + block.text_chars)
+    for line, owner in enumerate(owners):
+        keep[line] = not dropped[owner]
+    cut = sum(len(line) + 1 for line, kept in zip(lines, keep) if not kept)
+    print(f"Boilerplate filter: dropped {keep.count(False)} of {len(lines)} blocks "
+          f"({cut} of {sum(len(line) + 1 for line in lines)} chars)")
+    return keep
+
+
+class _BlockStats:
+    """Running totals for one block, its descendants included once it closes."""
+
+    __slots__ = ('parent', 'depth', 'text_chars', 'link_chars', 'links')
+
+    def __init__(self, parent, depth):
+        self.parent = parent
+        self.depth = depth
+        self.text_chars = 0
+        self.link_chars = 0
+        self.links = 0
+
+
+class _LineBuffer:
+    """Assemble condensed lines in one forward pass.
+
+    Equivalent to wrapping every non-empty block as "\\n{hint}{clean_text(children)}\\n"
+    and cleaning again at each ancestor, without ever re-joining or re-cleaning
+    a subtree. A block's opening newline and hint are held back until its first
+    non-whitespace content arrives, so an empty block leaves no trace, and a
+    hint lands on the block's first line even when that line belongs to a
+    nested block.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.tiers = []  # per line, see _hint_tier
+        self.owners = []  # per line, the index in blocks of its innermost block
+        self.blocks = [_BlockStats(0, 0)]  # 0 is the page itself
+        self._line = []
+        self._line_in_block = False
+        self._line_tier = 0
+        self._line_owner = 0
+        self._tier = 0
+        self._pending_newline = False
+        self._pending_hints = []
+        # (block index, pending_newline before the block, content count at open, tier)
+        self._blocks = []
+        self._content_count = 0
+
+    def write(self, piece, text_chars=None, link_chars=0):
+        """Append piece; text_chars/link_chars say how much of it is page text vs link text."""
+        if not piece.strip():
+            # Whitespace at the start of a line (or inside a block that may
+            # still turn out empty) would be stripped anyway.
+            if not self._pending_newline:
+                self._line.append(piece)
+            return
+        if self._pending_newline:
+            self._end_line()
+            self._pending_newline = False
+        owner = self._blocks[-1][0] if self._blocks else 0
+        if not self._line:
+            self._line_in_block = bool(self._blocks)
+            self._line_tier = self._tier
+            self._line_owner = owner
+        if self._pending_hints:
+            self._line.extend(self._pending_hints)
+            self._pending_hints.clear()
+        self._line.append(piece)
+        self._content_count += 1
+        stats = self.blocks[owner]
+        stats.text_chars += len(piece) if text_chars is None else text_chars
+        if link_chars:
+            stats.link_chars += link_chars
+            stats.links += 1
+
+    def open_block(self, hint):
+        parent = self._blocks[-1][0] if self._blocks else 0
+        self.blocks.append(_BlockStats(parent, len(self._blocks) + 1))
+        self._blocks.append((len(self.blocks) - 1, self._pending_newline, self._content_count, self._tier))
+        self._pending_newline = True
+        self._pending_hints.append(hint)
+        self._tier = max(self._tier, _hint_tier(hint))
+
+    def close_block(self):
+        index, pending_newline, content_count, self._tier = self._blocks.pop()
+        stats = self.blocks[index]
+        parent = self.blocks[stats.parent]
+        parent.text_chars += stats.text_chars
+        parent.link_chars += stats.link_chars
+        parent.links += stats.links
+        if self._content_count > content_count:
+            self._pending_newline = True
+        else:
+            # Empty block: nothing was written, so undo its newline and hint.
+            self._pending_newline = pending_newline
+            self._pending_hints.pop()
+
+    def _end_line(self):
+        if not self._line:
+            return
+        text = "".join(self._line)
+        self._line = []
+        if self._line_in_block:
+            # Text outside every block is only stripped, never collapsed.
+            text = _HSPACE_RE.sub(' ', text)
+        for line in text.split('\n'):
+            line = line.strip()
+            if line:
+                self.lines.append(line)
+                self.tiers.append(self._line_tier)
+                self.owners.append(self._line_owner)
+
+    def finish(self):
+        self._end_line()
+        return self.lines
+
+
+class _CondensedWriter:
+    """Turn element start/end and text events into (condensed, mapping).
+
+    Fed either by walking a parsed tree (dom_to_condensed) or directly by a
+    parser, so both produce the same text for the same tree.
+    """
+
+    def __init__(self, base_url=""):
+        self.mapping = {}
+        self.base_url = base_url
+        self._ids = {}  # (type, resolved URL) -> id
+        self._out = _LineBuffer()
+        # One entry per open element: (kind, data). Links collect their text in
+        # a buffer of their own, which is flattened onto one line at the end.
+        self._stack = []
+        self._links = []
+        self._skip_depth = 0
+        self._container_depth = 0
+
+    def start(self, name, attrs):
+        if self._skip_depth or name in SKIP_TAGS:
+            self._skip_depth += 1
+            self._stack.append(('skip', None))
+            return
+        if name == 'a':
+            href = attrs.get('href')
+            if not href:
+                # Not a link: its children are dropped along with it.
+                self._skip_depth += 1
+                self._stack.append(('skip', None))
+                return
+            self._links.append(self._out)
+            self._out = _LineBuffer()
+            self._stack.append(('a', href))
+            return
+        if name == 'img':
+            src = attrs.get('src')
             if src:
-                id_val = next_id; next_id += 1
-                mapping[id_val] = {'type': 'img', 'src': src, 'alt': node.get('alt', '')}
-                return f"![{node.get('alt', '').strip()}][{id_val}]"
-            return ""
-        elif type(node) == bs4.element.NavigableString:
-            return clean_inline(str(node))
-        elif node.name is not None:
-            is_block = node.name in block_tags
-            hint = ""
-            if node.name in ['nav', 'header', 'footer', 'aside']:
-                hint = f"({node.name.upper()}) "
-            classes = node.get('class', [])
-            if classes:
-                classes_str = " ".join(classes).lower()
-                if any(bad in classes_str for bad in ['ad', 'sponsor', 'nav', 'menu', 'sidebar', 'footer', 'header', 'promo']):
-                    hint = f"({node.name.upper()} hint:{' '.join(classes)}) "
-            children_text = "".join(process_node(c) for c in node.children)
-            if is_block:
-                clean_children = clean_text(children_text)
-                if clean_children:
-                    return f"\n{hint}{clean_children}\n"
-                return ""
-            else:
-                return children_text
-        return ""
-
-    body = soup.find('body') or soup
-    raw_condensed = process_node(body)
-    # One block per line; drop blank and whitespace-only lines.
-    lines = (line.strip() for line in raw_condensed.split('\n'))
-    condensed = '\n'.join(line for line in lines if line)
-    return condensed, mapping
-
-def _get_llm_client():
-    model_provider = os.getenv("AI_PROVIDER")
-    if model_provider == "cerebras":
-        api_key = os.getenv("CEREBRAS_API_KEY")
-        base_url = "https://api.cerebras.ai/v1"
-        model_name = os.getenv("CEREBRAS_MODEL")
-    elif model_provider == "gemini":
-        api_key = os.getenv("GEMINI_API_KEY")
-        base_url = "https://generativelanguage.googleapis.com/v1beta/openai"
-        model_name = os.getenv("GEMINI_MODEL")
-    elif model_provider == "groq":
-        api_key = os.getenv("GROQ_API_KEY")
-        base_url = "https://api.groq.com/openai/v1"
-        model_name = os.getenv("GROQ_MODEL")
-    elif model_provider == "openai":
-        api_key = os.getenv("OPENAI_API_KEY")
-        base_url = "https://api.openai.com/v1"
-        model_name = os.getenv("OPENAI_MODEL")
-    else:
+                alt = attrs.get('alt', '')
+                id_val = self._id_for('img', src, {'type': 'img', 'src': src, 'alt': alt})
+                self._out.write(f"![{alt.strip()}][{id_val}]", text_chars=0)
+            self._skip_depth += 1
+            self._stack.append(('skip', None))
+            return
+        if name in STRING_CONTAINER_TAGS:
+            self._container_depth += 1
+        if name in BLOCK_TAGS:
+            self._out.open_block(_block_hint(name, attrs.get('class', [])))
+            self._stack.append(('block', name))
+        else:
+            self._stack.append(('inline', name))
+
+    def end(self):
+        kind, data = self._stack.pop()
+        if kind == 'skip':
+            self._skip_depth -= 1
+            return
+        if kind == 'a':
+            # Link text must stay on one line or the [text][id] reference breaks.
+            text = clean_inline(" ".join(self._out.finish())).strip()
+            self._out = self._links.pop()
+            if text:
+                id_val = self._id_for('a', data, {'type': 'a', 'href': data})
+                self._out.write(f"[{text}][{id_val}]", text_chars=0, link_chars=len(text))
+            return
+        if data in STRING_CONTAINER_TAGS:
+            self._container_depth -= 1
+        if kind == 'block':
+            self._out.close_block()
+
+    def text(self, data):
+        if not self._skip_depth and not self._container_depth:
+            self._out.write(clean_inline(data))
+
+    def enter_containers(self, depth):
+        """Start inside depth string containers (rt, template...) that are outside the walked tree."""
+        self._container_depth += depth
+
+    def close(self, token_budget=None, boilerplate=None):
+        while self._stack:
+            self.end()
+        out = self._out
+        lines, tiers = out.finish(), out.tiers
+        total = len(lines)
+        if BOILERPLATE_FILTER if boilerplate is None else boilerplate:
+            keep = _drop_boilerplate(lines, out.owners, out.blocks)
+            lines = [line for line, kept in zip(lines, keep) if kept]
+            tiers = [tier for tier, kept in zip(tiers, keep) if kept]
+        if token_budget is not None:
+            keep = _fit_budget(lines, tiers, token_budget)
+            lines = [line for line, kept in zip(lines, keep) if kept]
+        mapping = self.mapping
+        if len(lines) < total:
+            # Only the ids still referenced in the text stay in the mapping.
+            used = {int(id_val) for line in lines for id_val in ID_REF_RE.findall(line)}
+            mapping = {id_val: data for id_val, data in mapping.items() if id_val in used}
+        return '\n'.join(lines), mapping
+
+    def _id_for(self, kind, url, entry):
+        """One id per distinct target: a page linking the same URL 40 times maps it once.
+
+        Ids are handed out only to links/images that appear in the text, in
+        order, so they stay short (1-3 digits, a single token on common tokenizers).
+        """
+        key = (kind, urljoin(self.base_url, url) if self.base_url else url)
+        id_val = self._ids.get(key)
+        if id_val is None:
+            id_val = self._ids[key] = len(self._ids) + 1
+            self.mapping[id_val] = entry
+        return id_val
+
+
+def _walk(root, writer):
+    """Replay the subtree under root as writer events, without recursion."""
+    writer.start(root.name, root.attrs)
+    stack = [iter(root.contents)]
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+            writer.end()
+        elif type(node) is bs4.element.NavigableString:
+            writer.text(node)
+        elif isinstance(node, bs4.element.Tag):
+            writer.start(node.name, node.attrs)
+            stack.append(iter(node.contents))
+        # Comments, doctypes and other special strings contribute nothing.
+
+
+def _find_body(soup):
+    body = soup.find('body')
+    if body is None or not any(p.name in SKIP_TAGS for p in body.parents):
+        return body
+    # Rare: a <body> nested in a skipped element does not count as the body.
+    return next((b for b in soup.find_all('body')
+                 if not any(p.name in SKIP_TAGS for p in b.parents)), None)
+
+
+def dom_to_condensed(html_content, parser=None, token_budget=None, boilerplate=None, base_url=""):
+    """Condense a page to one block per line, with links/images replaced by ids.
+
+    Returns (condensed, mapping). Links/images to the same URL (resolved against
+    base_url) share an id. boilerplate (default: DARKLY_BOILERPLATE_FILTER)
+    drops link-dense blocks outside the main content, see _drop_boilerplate.
+    With token_budget, whole blocks are then dropped (hinted boilerplate first,
+    see _fit_budget) until the text fits.
+    """
+    soup = BeautifulSoup(html_content, parser or HTML_PARSER)
+    writer = _CondensedWriter(base_url)
+    _walk(_find_body(soup) or soup, writer)
+    return writer.close(token_budget, boilerplate)
+
+class StreamingCondenser(HTMLParser):
+    """Push-style dom_to_condensed: feed() HTML as it downloads, finish() at the end.
+
+    Builds no tree. Start/end tags are matched the way BeautifulSoup's
+    html.parser builder matches them (an end tag closes the most recent open
+    element of that name, void elements never stay open), so the result is the
+    same as dom_to_condensed(html, "html.parser") on the concatenated input.
+    """
+
+    def __init__(self, base_url=""):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.length = 0
+        self._open = []
+        self._closed_void = []
+        self._text = []
+        # Everything goes to the page writer until the first <body> starts; from
+        # then on only the body does. Without a <body>, the whole document is
+        # the page.
+        self._page = self._writer = _CondensedWriter(base_url)
+        self._writer.start('[document]', {})
+        self._body_level = None
+
+    def feed(self, data):
+        self.length += len(data)
+        super().feed(data)
+
+    def finish(self, token_budget=None, boilerplate=None):
+        self.close()
+        self._flush_text()
+        return self._page.close(token_budget, boilerplate)
+
+    def handle_starttag(self, tag, attrs, close_void=True):
+        self._flush_text()
+        if tag == 'body' and self._body_level is None and not SKIP_TAGS.intersection(self._open):
+            self._page = self._writer = _CondensedWriter(self.base_url)
+            self._writer.enter_containers(sum(name in STRING_CONTAINER_TAGS for name in self._open))
+            self._body_level = len(self._open)
+        self._open.append(tag)
+        if self._writer is not None:
+            attr_dict = {}
+            for key, value in attrs:
+                attr_dict[key] = "" if value is None else value
+            if 'class' in attr_dict:
+                attr_dict['class'] = attr_dict['class'].split()
+            self._writer.start(tag, attr_dict)
+        if tag in VOID_TAGS and close_void:
+            # Closed on the spot; a later explicit </tag> for it is ignored.
+            self._pop_to(tag)
+            self._closed_void.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, close_void=False)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self._closed_void:
+            self._closed_void.remove(tag)
+            return
+        self._flush_text()
+        self._pop_to(tag)
+
+    def _pop_to(self, tag):
+        if tag not in self._open:
+            return
+        while True:
+            name = self._open.pop()
+            if self._writer is not None:
+                self._writer.end()
+                if len(self._open) == self._body_level:
+                    self._writer = None  # the body is over
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        self._text.append(data)
+
+    # Each of these ends the current text node, like the separate Comment etc.
+    # objects a parsed tree would hold.
+    def handle_comment(self, data):
+        self._flush_text()
+
+    def handle_decl(self, decl):
+        self._flush_text()
+
+    def handle_pi(self, data):
+        self._flush_text()
+
+    def unknown_decl(self, data):
+        self._flush_text()
+
+    def _flush_text(self):
+        if self._text:
+            text = "".join(self._text)
+            self._text = []
+            if self._writer is not None:
+                self._writer.text(text)
+
+
+# Every provider speaks the OpenAI chat-completions API. AI_PROVIDER picks one;
+# it reads {PREFIX}_API_KEY, {PREFIX}_MODEL and (optionally) {PREFIX}_TOKEN_BUDGET.
+PROVIDERS = {
+    "cerebras": ("CEREBRAS", "https://api.cerebras.ai/v1"),
+    "gemini": ("GEMINI", "https://generativelanguage.googleapis.com/v1beta/openai"),
+    "groq": ("GROQ", "https://api.groq.com/openai/v1"),
+    "openai": ("OPENAI", "https://api.openai.com/v1"),
+    # darkly_stub_llm.py: a local fake with scripted latency, for offline runs
+    # and benchmarks. Needs no key; STUB_MODEL defaults to "stub".
+    "stub": ("STUB", os.getenv("STUB_BASE_URL", "http://127.0.0.1:5338/v1")),
+}
+
+# Connection pool for each LLM client. Keep-alive is what makes a client worth
+# reusing: the second page skips DNS, TCP and TLS to the provider. HTTP/2 needs
+# the h2 package (pip install 'httpx[http2]').
+LLM_HTTP2 = os.getenv("DARKLY_LLM_HTTP2", "").lower() in ("1", "true", "yes")
+LLM_POOL_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("DARKLY_LLM_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("DARKLY_LLM_MAX_KEEPALIVE", "20")),
+    keepalive_expiry=float(os.getenv("DARKLY_LLM_KEEPALIVE_EXPIRY", "120")),
+)
+
+# Long-lived clients: event loop -> {(provider, api key): AsyncOpenAI}. An httpx
+# pool belongs to the loop it was opened on, so each loop gets its own; entries
+# go away with their loop, and close_llm_clients() closes them first.
+_llm_clients = weakref.WeakKeyDictionary()
+
+def _get_llm_client(model_provider=None):
+    """The pooled client for a provider (default AI_PROVIDER) on the running loop,
+    and the model name.
+
+    Returns (None, None) for an unknown provider. Callers must not close the
+    client; it is shared by every page on this loop.
+    """
+    model_provider = model_provider or os.getenv("AI_PROVIDER")
+    if model_provider not in PROVIDERS:
         return None, None
+    prefix, base_url = PROVIDERS[model_provider]
+    api_key = os.getenv(f"{prefix}_API_KEY")
+    model = os.getenv(f"{prefix}_MODEL")
+    if model_provider == "stub":
+        api_key, model = api_key or "stub", model or "stub"
+    clients = _llm_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get((model_provider, api_key))
+    if client is None:
+        http_client = DefaultAsyncHttpxClient(limits=LLM_POOL_LIMITS, http2=LLM_HTTP2)
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+        clients[(model_provider, api_key)] = client
+    return client, model
+
+async def close_llm_clients():
+    """Close the pooled clients of the running loop. Call before the loop shuts down."""
+    clients = _llm_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
+
+# Admission control per provider, from {PREFIX}_MAX_CONCURRENT (streams at
+# once), {PREFIX}_RPM (requests per minute) and {PREFIX}_TPM (prompt tokens per
+# minute); see darkly_admission. Like the clients, gates belong to a loop.
+_gates = weakref.WeakKeyDictionary()
+
+def _env_number(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+def _gate(provider):
+    gates = _gates.setdefault(asyncio.get_running_loop(), {})
+    gate = gates.get(provider)
+    if gate is None:
+        prefix = PROVIDERS[provider][0]
+        gate = gates[provider] = ProviderGate(
+            provider, _env_number(f"{prefix}_MAX_CONCURRENT"),
+            _env_number(f"{prefix}_RPM"), _env_number(f"{prefix}_TPM"))
+    return gate
+
+def admission_snapshot():
+    """Per provider: streams in flight, queue depth by priority and recent waits."""
+    return {name: gate.snapshot() for gates in list(_gates.values())
+            for name, gate in gates.items()}
+
+def generation_settings():
+    """What a simplified page depends on besides the page itself: the
+    instructions and the configured provider and model."""
+    provider = os.getenv("AI_PROVIDER")
+    prefix = PROVIDERS.get(provider, ("DARKLY",))[0]
+    return current_instructions, provider, os.getenv(f"{prefix}_MODEL")
+
+def _token_budget():
+    """Condensed-text token budget for the current provider, or None for no limit."""
+    prefix = PROVIDERS.get(os.getenv("AI_PROVIDER"), ("DARKLY",))[0]
+    value = os.getenv(f"{prefix}_TOKEN_BUDGET") or os.getenv("DARKLY_TOKEN_BUDGET")
+    return int(value) if value else None
+
+async def _iter_sse_data(response):
+    """Yield the parsed JSON of each server-sent event in a streamed completion.
+
+    Reads the body to the very end. The SDK's own stream iterator closes the
+    response at "data: [DONE]", before the HTTP/1.1 terminating chunk has been
+    read, which makes httpx drop the connection instead of pooling it.
+    """
+    async for line in response.iter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            continue
+        event = json.loads(data)
+        if event.get("error"):
+            error = event["error"]
+            message = error.get("message") if isinstance(error, dict) else None
+            raise RuntimeError(message or "An error occurred during streaming")
+        yield event
 
-    client = AsyncOpenAI(api_key=api_key, base_url=base_url)
-    return client, model_name
+async def _stream_completion(client, model_name, messages, route=None, max_tokens=None,
+                             priority=PRIORITY_DOCUMENT, report=None):
+    """Stream one completion's content. With route ("provider/model"), how it
+    went is reported to the router, and the call first waits for admission by
+    the provider's gate, at priority. report, a dict, gets the "finish_reason"
+    of a completion that streamed to its end."""
+    provider = route.split("/", 1)[0] if route else None
+    gate = _gate(provider) if provider in PROVIDERS else None
+    if gate:
+        cost = sum(len(message["content"]) for message in messages) // CHARS_PER_TOKEN
+        waited = await gate.acquire(priority, cost)
+        if waited > 0.05:
+            print(f"Admission: waited {waited:.2f}s for {provider} ({gate.snapshot()['queued']} still queued)")
+    try:
+        async for content in _stream_admitted(client, model_name, messages, route, max_tokens,
+                                              report):
+            yield content
+    finally:
+        if gate:
+            gate.release()
+
+# Generations stopped before their end because their reader went away, how
+# much they had produced, and how much output stopping them saved (estimated: a
+# rewrite of the page is about as long as the page).
+cancel_stats = {"cancelled": 0, "tokens_generated": 0, "tokens_saved_estimate": 0}
+
+# Why a generation is cancelled, passed down as the cancel message
+# (task.cancel(READER_GONE)). Only a reader going away saves anything; a hedge
+# that lost is what hedging costs, and is counted in hedge_stats. Anything else
+# (a sibling segment failed, shutdown) is not counted.
+READER_GONE = "reader went away"
+HEDGE_LOST = "hedge lost"
 
-async def _call_llm_stream(client, model_name, prompt):
+def _cancel_reason(e):
+    return e.args[0] if isinstance(e, asyncio.CancelledError) and e.args else None
+
+def _record_cancel(model_name, messages, max_tokens, chunks, elapsed):
+    expected = len(messages[-1]["content"]) // CHARS_PER_TOKEN
+    if max_tokens:
+        expected = min(expected, max_tokens)
+    saved = max(0, expected - chunks)
+    cancel_stats["cancelled"] += 1
+    cancel_stats["tokens_generated"] += chunks
+    cancel_stats["tokens_saved_estimate"] += saved
+    print(f"--- AI Generation ({model_name}) cancelled after {elapsed:.2f}s and ~{chunks} tokens, "
+          f"~{saved} tokens saved ({cancel_stats['tokens_saved_estimate']} in total) ---")
+
+async def _stream_admitted(client, model_name, messages, route, max_tokens, report=None):
     start_time = time.time()
-    response = await client.chat.completions.create(
-        model=model_name,
-        messages=[{"role": "user", "content": prompt}],
-        stream=True
-    )
-    async for chunk in response:
-        if chunk.choices and chunk.choices[0].delta.content:
-            yield chunk.choices[0].delta.content
+    first_token = None
+    chunks = 0
+    usage = None
+    finish_reason = None
+    options = {"max_tokens": max_tokens} if max_tokens else {}
+    try:
+        async with client.chat.completions.with_streaming_response.create(
+            model=model_name,
+            messages=messages,
+            stream=True,
+            # The totals arrive in a last event with no choices.
+            stream_options={"include_usage": True},
+            **options,
+        ) as response:
+            async for event in _iter_sse_data(response):
+                # Groq reports usage in its own x_groq field.
+                usage = event.get("usage") or (event.get("x_groq") or {}).get("usage") or usage
+                choices = event.get("choices")
+                content = choices and (choices[0].get("delta") or {}).get("content")
+                finish_reason = choices and choices[0].get("finish_reason") or finish_reason
+                if content:
+                    if first_token is None:
+                        first_token = time.time() - start_time
+                    chunks += 1
+                    yield content
+    except Exception as e:
+        if route:
+            router.record_failure(route, e, getattr(e, "status_code", None))
+        raise
+    except (asyncio.CancelledError, GeneratorExit) as e:
+        # Stopped from outside: the reader went away, a hedge lost, or whatever else.
+        reason = _cancel_reason(e)
+        if reason == READER_GONE:
+            _record_cancel(model_name, messages, max_tokens, chunks, time.time() - start_time)
+        elif reason == HEDGE_LOST and route:
+            _record_hedge_spend(route.split("/")[0], messages, chunks)
+        raise
     duration = time.time() - start_time
-    print(f"--- AI Generation ({model_name}) took {duration:.2f}s ---")
+    ttft = f"{first_token:.2f}s" if first_token is not None else "-"
+    print(f"--- AI Generation ({model_name}) took {duration:.2f}s, first token {ttft} ---")
+    if finish_reason == "length":
+        print(f"--- Output cut off at max_tokens={max_tokens} ---")
+    if report is not None:
+        report["finish_reason"] = finish_reason
+    if usage:
+        # cached = prompt tokens the provider served from its prefix cache.
+        details = usage.get("prompt_tokens_details") or {}
+        print(f"--- Tokens ({model_name}): prompt {usage.get('prompt_tokens')} "
+              f"(cached {details.get('cached_tokens') or 0}), "
+              f"completion {usage.get('completion_tokens')} ---")
+    if route:
+        if first_token is None:
+            router.record_failure(route, "empty response")
+        else:
+            # Without usage, streamed chunks are roughly one token each.
+            tokens = (usage or {}).get("completion_tokens") or chunks
+            router.record_success(route, first_token, tokens / max(duration - first_token, 1e-3))
+
+
+# With DARKLY_ROUTING, every page goes to the provider/model with the best
+# recent latency, failing over to the next if it errors before any content;
+# see darkly_router. Results are recorded either way.
+ROUTING = os.getenv("DARKLY_ROUTING", "").lower() in ("1", "true", "yes")
+router = Router()
+PROBE_MESSAGES = [{"role": "user", "content": "Reply with the single word OK."}]
+_probe_tasks = set()
+
+# Hedging: if the first provider has not produced content within
+# DARKLY_HEDGE_DELAY seconds, start the next one too, and so on; the first to
+# produce content wins and the others are cancelled. Unset = off, 0 = race
+# them all at once.
+HEDGE_DELAY = os.getenv("DARKLY_HEDGE_DELAY")
+HEDGE_DELAY = float(HEDGE_DELAY) if HEDGE_DELAY else None
+
+# provider -> [wins, losses, tokens spent on losses (prompt and output, estimated)]
+# since startup.
+hedge_stats = {}
+
+def _record_hedge_spend(provider, messages, chunks):
+    prompt = sum(len(message["content"]) for message in messages) // CHARS_PER_TOKEN
+    hedge_stats.setdefault(provider, [0, 0, 0])[2] += prompt + chunks
+
+def _llm_providers(primary=None):
+    """primary (default AI_PROVIDER), then the backups: DARKLY_BACKUP_PROVIDERS
+    (comma-separated), or else every other provider with an API key and a model
+    configured."""
+    primary = primary or os.getenv("AI_PROVIDER")
+    names = os.getenv("DARKLY_BACKUP_PROVIDERS")
+    if names:
+        backups = [name.strip() for name in names.split(",") if name.strip()]
+    else:
+        backups = [name for name, (prefix, _) in PROVIDERS.items()
+                   if os.getenv(f"{prefix}_API_KEY") and os.getenv(f"{prefix}_MODEL")]
+    return [primary] + [name for name in backups if name in PROVIDERS and name != primary]
+
+def _eligible_llms(client, model_name, provider=None):
+    """[(route, client, model)] that may answer a call: provider (default
+    AI_PROVIDER) first, then with routing or hedging, the backups."""
+    providers = _llm_providers(provider)
+    candidates = [(f"{providers[0]}/{model_name}", client, model_name)]
+    if not ROUTING and HEDGE_DELAY is None:
+        return candidates
+    for name in providers[1:]:
+        backup, backup_model = _get_llm_client(name)
+        candidates.append((f"{name}/{backup_model}", backup, backup_model))
+    return candidates
+
+def _llm_candidates(client, model_name, provider=None):
+    """[(route, client, model)] to try, in order: provider (default AI_PROVIDER)
+    first, or with routing, best first. client/model_name are provider's."""
+    candidates = _eligible_llms(client, model_name, provider)
+    if not ROUTING:
+        return candidates
+    for route, probe_client, probe_model in candidates:
+        if route in router.due_probes([route]):
+            task = asyncio.create_task(_probe(probe_client, probe_model, route))
+            _probe_tasks.add(task)  # the loop only keeps weak references
+            task.add_done_callback(_probe_tasks.discard)
+    by_route = {candidate[0]: candidate for candidate in candidates}
+    return [by_route[route] for route in router.rank(list(by_route))]
+
+async def _probe(client, model_name, route):
+    """A tiny background request to an open circuit; success closes it."""
+    print(f"Router: probing {route}")
+    try:
+        async for _ in _stream_completion(client, model_name, PROBE_MESSAGES, route,
+                                          priority=PRIORITY_BACKGROUND):
+            pass
+    except Exception:
+        pass  # already recorded, which re-opens the circuit
+
+async def _first_content(stream):
+    """Wait for a stream's first chunk. Returns (stream, chunk); chunk is None if it was empty."""
+    return stream, await anext(stream, None)
+
+async def _failover_stream(candidates, messages, max_tokens=None, priority=PRIORITY_DOCUMENT,
+                           report=None):
+    """Stream from the first candidate that produces content. A failure after
+    content has started cannot be retried and is raised."""
+    for i, (route, client, model_name) in enumerate(candidates):
+        stream = _stream_completion(client, model_name, messages, route, max_tokens, priority,
+                                    report)
+        try:
+            chunk = await anext(stream, None)
+        except Exception as e:
+            if i == len(candidates) - 1:
+                raise
+            print(f"Router: {route} failed ({e}), trying {candidates[i + 1][0]}")
+            continue
+        if report is not None:
+            report["route"] = route
+        if chunk is None:
+            return
+        yield chunk
+        async for chunk in stream:
+            yield chunk
+        return
+
+async def _hedged_stream(candidates, messages, max_tokens=None, priority=PRIORITY_DOCUMENT,
+                         report=None):
+    loop = asyncio.get_running_loop()
+    running = {}  # task -> route
+    next_start = loop.time()
+    winner = error = None
+    reason = HEDGE_LOST
+    try:
+        while winner is None:
+            if candidates and (not running or loop.time() >= next_start):
+                route, candidate, candidate_model = candidates.pop(0)
+                stream = _stream_completion(candidate, candidate_model, messages, route,
+                                            max_tokens, priority, report)
+                running[asyncio.create_task(_first_content(stream))] = route
+                next_start = loop.time() + HEDGE_DELAY
+                continue
+            if not running:
+                raise error
+            timeout = max(0, next_start - loop.time()) if candidates else None
+            done, _ = await asyncio.wait(running, timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                route = running.pop(task)
+                name = route.split("/")[0]
+                if task.exception() is not None:
+                    # A failed provider just drops out of the race (and lets the
+                    # next one start right away); only losing them all is an error.
+                    error = task.exception()
+                    print(f"Hedge: {name} failed: {error}")
+                    next_start = loop.time()
+                elif winner is None:
+                    winner = route, task.result()
+                else:
+                    # Finished in the same instant as the winner: still a loss.
+                    hedge_stats.setdefault(name, [0, 0, 0])[1] += 1
+                    _record_hedge_spend(name, messages, 1)
+                    await task.result()[0].aclose()
+    except asyncio.CancelledError as e:
+        reason = _cancel_reason(e)  # the race itself was called off
+        raise
+    finally:
+        for task, loser in running.items():
+            task.cancel(reason)
+            if winner:
+                hedge_stats.setdefault(loser.split("/")[0], [0, 0, 0])[1] += 1
+
+    route, (stream, chunk) = winner
+    name = route.split("/")[0]
+    if report is not None:
+        report["route"] = route
+    hedge_stats.setdefault(name, [0, 0, 0])[0] += 1
+    tally = ", ".join(f"{p} {w}/{l}" for p, (w, l, _) in sorted(hedge_stats.items()))
+    print(f"Hedge: {name} produced content first (wins/losses: {tally})")
+    if chunk is None:
+        return
+    yield chunk
+    async for chunk in stream:
+        yield chunk
+
+def _call_llm_stream(client, model_name, messages, provider=None, max_tokens=None,
+                     priority=PRIORITY_DOCUMENT, report=None):
+    """Stream the model's answer to messages: routed and hedged across providers if configured.
+
+    client/model_name belong to provider (default AI_PROVIDER). priority orders
+    the call in the provider's admission queue. report, a dict, gets the
+    "provider/model" route that produced the answer once it is known, and the
+    "finish_reason" once it is complete ("length": cut off at max_tokens).
+    """
+    candidates = _llm_candidates(client, model_name, provider)
+    if HEDGE_DELAY is not None:
+        return _hedged_stream(candidates, messages, max_tokens, priority, report)
+    if ROUTING:
+        return _failover_stream(candidates, messages, max_tokens, priority, report)
+    route, client, model_name = candidates[0]
+    if report is not None:
+        report["route"] = route
+    return _stream_completion(client, model_name, messages, route, max_tokens, priority, report)
+
+
+# Size rules: a JSON list, first match wins, e.g.
+#   [{"max_chars": 6000, "provider": "groq", "model": "llama-3.1-8b-instant"},
+#    {"min_chars": 120000, "provider": "gemini"}]
+# Conditions: min_chars/max_chars (condensed length), min_ids/max_ids (links and
+# images). "model" defaults to the provider's {PREFIX}_MODEL, "provider" to
+# AI_PROVIDER; "max_output_ratio" overrides DARKLY_MAX_OUTPUT_RATIO.
+SIZE_RULES = json.loads(os.getenv("DARKLY_SIZE_RULES") or "[]")
+
+# Cap each generation's output at this multiple of its input (estimated
+# tokens), never below MIN_OUTPUT_TOKENS, so a runaway generation cannot run
+# on. The output is a rewrite of the input, so it should rarely exceed it;
+# leave room for reasoning models, which count their reasoning too. Unset = no cap.
+MAX_OUTPUT_RATIO = os.getenv("DARKLY_MAX_OUTPUT_RATIO")
+MAX_OUTPUT_RATIO = float(MAX_OUTPUT_RATIO) if MAX_OUTPUT_RATIO else None
+MIN_OUTPUT_TOKENS = 1024
+
+def _size_rule(condensed, mapping):
+    """The first SIZE_RULES entry matching the page, or {}."""
+    chars, ids = len(condensed), len(mapping)
+    for rule in SIZE_RULES:
+        if (rule.get("min_chars", 0) <= chars <= rule.get("max_chars", chars)
+                and rule.get("min_ids", 0) <= ids <= rule.get("max_ids", ids)):
+            return rule
+    return {}
+
+def _output_cap(text, ratio):
+    """max_tokens for generating from text, or None for no cap."""
+    if not ratio:
+        return None
+    return max(MIN_OUTPUT_TOKENS, int(len(text) / CHARS_PER_TOKEN * ratio))
+
 
 LIST_ITEM_RE = re.compile(r'^ {0,3}([-*+]|\d{1,9}[.)])\s')
 TABLE_ROW_RE = re.compile(r'^ {0,3}\|')
 BLOCKQUOTE_RE = re.compile(r'^ {0,3}>')
 FENCE_RE = re.compile(r'^ {0,3}(```|~~~)')
+# Re-render a held-back list or table for early output once it has grown by
+# this factor since the last time: the first rows show at once, and the total
+# rendering work stays proportional to its length.
+PROGRESSIVE_GROWTH = 1.5
+SETEXT_UNDERLINE_RE = re.compile(r'^ {0,3}(=+|-+)\s*$')
+# restore_ids' tokens, found in one left-to-right pass: a reference image, a
+# reference link (whose text may hold reference images), or the <a>/<img> that
+# Markdown made of an inline link to "id:N".
+ID_TOKEN_RE = re.compile(
+    r'!\[(?P<alt>[^\]]*)\]\[(?P<img_id>\d+)\]'
+    r'|\[(?P<text>(?:!\[[^\]]*\]\[\d+\]|(?!!\[[^\]]*\]\[\d+\])[^\]])+)\]\[(?P<a_id>\d+)\]'
+    r'|<a[^>]*href="(?P<href>[^"]+)"[^>]*>(?P<inner>.*?)</a>'
+    r'|<img[^>]*alt="(?P<img_alt>[^"]*)"[^>]*src="(?P<src>[^"]+)"[^>]*>'
+)
 TRAILING_FENCE_RE = re.compile(r'\n? {0,3}(```|~~~)\s*$')
 
 
@@ -204,6 +1033,10 @@ class MarkdownStreamParser:
     "\\n\\n" turns one loose list into N single-item <ul>s. So a blank line is
     only treated as a boundary once the following line proves the construct has
     actually ended -- which means holding the tail back until that line arrives.
+
+    Lists and tables are not held back whole: an item is settled once the next
+    one starts, so the rendering up to the last item is sent early (container
+    left open), and the rest follows when the construct ends.
     """
 
     def __init__(self, mapping, base_url="", proxy_prefix=""):
@@ -213,6 +1046,22 @@ class MarkdownStreamParser:
         self.buffer = ""
         self.md = markdown.Markdown(extensions=["tables", "fenced_code"])
         self._leading_fence_handled = False
+        self._early = []     # HTML of the current block sent ahead of it
+        self._sent = ""      # all of the current block's HTML sent so far
+        self._urls = {}      # (id, attribute) -> safe_url result
+        self._reset_scan()
+
+    def _reset_scan(self):
+        """Forget how far the buffer was scanned; call whenever it is replaced."""
+        self._pos = 0           # start of the first line not scanned yet
+        self._searched = 0      # buffer[_pos:_searched] is known to hold no newline
+        self._in_fence = False
+        self._last = None       # last non-blank line of the block so far
+        self._blank = None      # start of the blank lines that may end the block
+        self._kind = None       # the block's list marker ("-", "." ...) or "|" for a table
+        self._lines = 0         # non-blank lines in the block
+        self._rendered_at = 0   # block length at the last early rendering
+        self._pending = None    # end of an item line that may be sent early
 
     def process_chunk(self, chunk_text):
         self.buffer += chunk_text
@@ -221,7 +1070,10 @@ class MarkdownStreamParser:
 
     def finish(self):
         self._strip_leading_fence(force=True)
-        self.buffer = TRAILING_FENCE_RE.sub('', self.buffer)
+        buffer = TRAILING_FENCE_RE.sub('', self.buffer)
+        if buffer != self.buffer:
+            self.buffer = buffer
+            self._reset_scan()  # the stripped fence may have been scanned already
         return self._drain(final=True)
 
     def _strip_leading_fence(self, force=False):
@@ -240,82 +1092,140 @@ class MarkdownStreamParser:
             return
         self.buffer = re.sub(r'^\s*(```|~~~)[^\n]*\n?', '', self.buffer)
         self._leading_fence_handled = True
+        self._reset_scan()
 
     def _drain(self, final):
         out = []
         while True:
             block = self._take_block(final)
+            out.extend(self._early)
+            self._early = []
             if block is None:
                 break
             html = self._render(block)
+            if self._sent:
+                if html.startswith(self._sent):
+                    html = html[len(self._sent):]
+                else:
+                    # Never expected; repeating some content beats losing it.
+                    print("Markdown: early output of a list/table did not match its final rendering")
+                self._sent = ""
             if html:
                 out.append(html)
         return "".join(out)
 
     def _take_block(self, final):
-        """Pop one renderable block off the buffer, or None if we must wait."""
-        if not self.buffer.strip():
-            if final:
-                self.buffer = ""
-            return None
-
-        lines = self.buffer.split("\n")
-        # The last element has no terminating newline yet, so it may be a partial
-        # line. Never make boundary decisions based on it.
-        complete = lines if final else lines[:-1]
-        tail = [] if final else lines[-1:]
-
-        in_fence = False
-        i = 0
-        n = len(complete)
-        while i < n:
-            line = complete[i]
-            if FENCE_RE.match(line):
-                in_fence = not in_fence
-                i += 1
-                continue
-            if in_fence or line.strip():
-                i += 1
-                continue
+        """Pop one renderable block off the buffer, or None if we must wait.
+
+        Scanning resumes where the previous call stopped, so a chunk costs time
+        in proportion to its own length rather than to the block it extends.
+        """
+        buffer = self.buffer
+        while self._pos <= len(buffer):
+            end = buffer.find("\n", max(self._pos, self._searched))
+            if end < 0:
+                # No terminating newline yet, so this may be a partial line.
+                # Never make boundary decisions based on it, until the end.
+                if not final:
+                    self._searched = len(buffer)
+                    return None
+                end = len(buffer)
+            start, self._pos = self._pos, end + 1
+            line = buffer[start:end]
+            if self._pending is not None:
+                self._send_early(buffer, line)
 
-            # Blank line outside a fence: a boundary, if nothing continues across it.
-            j = i
-            while j < n and not complete[j].strip():
-                j += 1
-            if j == n:
-                if final:
-                    block = "\n".join(complete[:i])
-                    self.buffer = ""
+            if self._blank is not None:
+                # After a blank line outside a fence: a boundary, if nothing
+                # continues across it.
+                if not line.strip():
+                    continue
+                if not self._continues(self._last, line):
+                    block = buffer[:self._blank]
+                    self.buffer = buffer[start:]
+                    self._reset_scan()
                     return block
-                return None  # cannot yet tell whether the construct continues
-            if self._continues(complete[:i], complete[j]):
-                i = j
+                self._blank = None
+
+            if FENCE_RE.match(line):
+                self._in_fence = not self._in_fence
+            elif not self._in_fence and not line.strip():
+                self._blank = start
                 continue
+            if line.strip():
+                self._last = line
+                self._lines += 1
+                if not final and not self._in_fence and self._starts_item(line):
+                    self._pending = end
 
-            block = "\n".join(complete[:i])
-            self.buffer = "\n".join(complete[j:] + tail)
-            return block
+        # Only reached when final: the rest is the last block.
+        block, self.buffer = buffer, ""
+        self._reset_scan()
+        return block if block.strip() else None
 
-        if final:
-            block = "\n".join(complete)
-            self.buffer = ""
-            return block
-        return None
+    def _starts_item(self, line):
+        """Does line start another item of a block that is one list or table?
 
-    @staticmethod
-    def _continues(previous_lines, next_line):
-        """Does next_line continue the construct that previous_lines ended with?"""
-        for last in reversed(previous_lines):
-            if not last.strip():
-                continue
-            if TABLE_ROW_RE.match(last) and TABLE_ROW_RE.match(next_line):
-                return True
-            if LIST_ITEM_RE.match(last) or last.startswith(("  ", "\t")):
-                return bool(LIST_ITEM_RE.match(next_line)
-                            or next_line.startswith(("  ", "\t")))
-            if BLOCKQUOTE_RE.match(last) and BLOCKQUOTE_RE.match(next_line):
+        Only blocks made of nothing else (items with the same marker and their
+        indented continuations, or table rows) are sent early: with anything
+        more, the rendering of what came before is not settled.
+        """
+        item = LIST_ITEM_RE.match(line)
+        if self._lines == 1:
+            self._kind = (item.group(1)[-1] if item
+                          else "|" if TABLE_ROW_RE.match(line) else None)
+            return False
+        if self._kind == "|":
+            if not TABLE_ROW_RE.match(line):
+                self._kind = None
+            return self._kind is not None and self._lines > 2  # after the delimiter row
+        if self._kind is None:
+            return False
+        if item:
+            if item.group(1)[-1] == self._kind:
                 return True
+            self._kind = None  # another marker may start another list
+        elif not line.startswith(("  ", "\t")):
+            self._kind = None  # a lazy continuation, heading, ...
+        return False
+
+    def _send_early(self, buffer, next_line):
+        """Send the block up to the start of the item whose first line ends at
+        self._pending. Its predecessors are settled now that next_line shows
+        it does not turn into a heading."""
+        end, self._pending = self._pending, None
+        if SETEXT_UNDERLINE_RE.match(next_line):
+            self._kind = None
+            return
+        if self._kind is None or end < self._rendered_at * PROGRESSIVE_GROWTH:
+            return
+        self._rendered_at = end
+        if self._kind == "|":
+            opening, cut = ("<table>",), "\n<tr>"
+        else:
+            opening, cut = ("<ul>", "<ol"), "\n<li>"
+        html = self._render(buffer[:end])
+        cut = html.rfind(cut) + 1
+        if not html.startswith(opening) or cut <= len(self._sent):
+            return
+        if not html.startswith(self._sent):
+            self._kind = None  # not what it looked like; wait for the end
+            return
+        self._early.append(html[len(self._sent):cut])
+        self._sent = html[:cut]
+
+    @staticmethod
+    def _continues(last, next_line):
+        """Does next_line continue the construct whose last non-blank line is last?"""
+        if last is None:
             return False
+        if TABLE_ROW_RE.match(last) and TABLE_ROW_RE.match(next_line):
+            return True
+        if LIST_ITEM_RE.match(last) or last.startswith(("  ", "\t")):
+            return bool(LIST_ITEM_RE.match(next_line)
+                        or next_line.startswith(("  ", "\t")))
+        if BLOCKQUOTE_RE.match(last) and BLOCKQUOTE_RE.match(next_line):
+            return True
         return False
 
     def _render(self, block):
@@ -331,96 +1241,326 @@ class MarkdownStreamParser:
         return sanitize_html(self.restore_ids(html)) + "\n"
 
     def restore_ids(self, value):
-        def mapped_url(id_val, key, fallback):
+        """Swap the ids in rendered HTML for their (safe) URLs, in one pass."""
+        return ID_TOKEN_RE.sub(self._restore_token, value)
+
+    def _mapped_url(self, id_val, key, fallback):
+        """safe_url of an id's target, or None; memoized, the same ids recur on every block."""
+        url = self._urls.get((id_val, key), False)
+        if url is False:
             data = self.mapping.get(id_val)
-            if not data:
-                return None
-            original = data.get(key) or data.get(fallback)
-            return safe_url(original, self.base_url, self.proxy_prefix) if original else None
+            original = data and (data.get(key) or data.get(fallback))
+            url = safe_url(original, self.base_url, self.proxy_prefix) if original else None
+            self._urls[(id_val, key)] = url
+        return url
+
+    def _image(self, id_val, alt, text):
+        """An id used with image syntax; alt is escaped for the attribute, text for the link."""
+        if self.mapping[id_val].get('type') == 'a':
+            # Image syntax on a link id (a thumbnail inside its anchor): an
+            # <img> pointing at the href would make the browser fetch an HTML
+            # page per thumbnail. Render a link instead.
+            href = self._mapped_url(id_val, "href", "src")
+            text = text.strip()
+            return f'<a href="{href}">{text}</a>' if href and text else text
+        src = self._mapped_url(id_val, "src", "href")
+        return f'<img src="{src}" alt="{alt}">' if src else alt
 
-        def replace_a(match):
-            text = match.group(1)
-            id_val = int(match.group(2))
+    def _restore_token(self, match):
+        if match.group("img_id"):
+            id_val = int(match.group("img_id"))
             if id_val not in self.mapping:
                 return match.group(0)
-            href = mapped_url(id_val, "href", "src")
-            return f'<a href="{href}">{text}</a>' if href else text
+            alt = match.group("alt")
+            return self._image(id_val, html_lib.escape(alt, quote=True), alt)
 
-        def replace_img(match):
-            alt = html_lib.escape(match.group(1), quote=True)
-            id_val = int(match.group(2))
+        if match.group("a_id"):
+            # The text may hold reference images (a linked thumbnail).
+            text = self.restore_ids(match.group("text"))
+            id_val = int(match.group("a_id"))
             if id_val not in self.mapping:
-                return match.group(0)
-            if self.mapping[id_val].get('type') == 'a':
-                # Image syntax on a link id (a thumbnail inside its anchor):
-                # an <img> pointing at the href would make the browser fetch
-                # an HTML page per thumbnail. Render a link instead.
-                href = mapped_url(id_val, "href", "src")
-                text = match.group(1).strip()
-                return f'<a href="{href}">{text}</a>' if href and text else text
-            src = mapped_url(id_val, "src", "href")
-            return f'<img src="{src}" alt="{alt}">' if src else alt
-
-        def replace_a_html(match):
-            href = html_lib.unescape(match.group(1))
+                return f'[{text}][{match.group("a_id")}]'
+            href = self._mapped_url(id_val, "href", "src")
+            return f'<a href="{href}">{text}</a>' if href else text
+
+        if match.group("href"):
+            inner = self.restore_ids(match.group("inner"))
+            start, end = match.span("inner")
+            unchanged = f'{match.string[match.start():start]}{inner}{match.string[end:match.end()]}'
+            href = html_lib.unescape(match.group("href"))
             if href.startswith("id:"):
                 try:
-                    mapped = mapped_url(int(href[3:]), "href", "src")
+                    mapped = self._mapped_url(int(href[3:]), "href", "src")
                 except ValueError:
-                    return match.group(0)
-                return f'<a href="{mapped}">{match.group(2)}</a>' if mapped else match.group(2)
+                    return unchanged
+                return f'<a href="{mapped}">{inner}</a>' if mapped else inner
             if self.proxy_prefix and href.startswith(("http://", "https://")):
                 # Links the model added itself (e.g. fact-check searches) are NOT
                 # proxied: search engines bot-block the server-side fetch. They
                 # open in a new tab because the result iframe cannot navigate to
                 # sites that refuse framing.
-                return f'<a href="{match.group(1)}" target="_blank">{match.group(2)}</a>'
+                return f'<a href="{match.group("href")}" target="_blank">{inner}</a>'
+            return unchanged
+
+        src = html_lib.unescape(match.group("src"))
+        if not src.startswith("id:"):
             return match.group(0)
+        try:
+            id_val = int(src[3:])
+        except ValueError:
+            return match.group(0)
+        alt = html_lib.escape(html_lib.unescape(match.group("img_alt")), quote=True)
+        if id_val not in self.mapping:
+            return alt
+        return self._image(id_val, alt, alt)
 
-        def replace_img_html(match):
-            src = html_lib.unescape(match.group(2))
-            if not src.startswith("id:"):
-                return match.group(0)
-            try:
-                id_val = int(src[3:])
-            except ValueError:
-                return match.group(0)
-            alt = html_lib.escape(html_lib.unescape(match.group(1)), quote=True)
-            if self.mapping.get(id_val, {}).get('type') == 'a':
-                # Same as replace_img: never render an anchor's href as an img.
-                href = mapped_url(id_val, "href", "src")
-                text = alt.strip()
-                return f'<a href="{href}">{text}</a>' if href and text else text
-            mapped = mapped_url(id_val, "src", "href")
-            return f'<img src="{mapped}" alt="{alt}">' if mapped else alt
-
-        value = re.sub(r'!\[([^\]]*)\]\[(\d+)\]', replace_img, value)
-        value = re.sub(r'\[([^\]]+)\]\[(\d+)\]', replace_a, value)
-        value = re.sub(r'<a[^>]*href="([^"]+)"[^>]*>(.*?)</a>', replace_a_html, value)
-        value = re.sub(
-            r'<img[^>]*alt="([^"]*)"[^>]*src="([^"]+)"[^>]*>',
-            replace_img_html,
-            value,
-        )
-        return value
-
-async def simplify_html_stream(html_content, base_url="", proxy_prefix=""):
+async def _condense_chunks(chunks, base_url=""):
+    """Run StreamingCondenser over chunks as they arrive. Returns the condenser."""
+    condenser = StreamingCondenser(base_url)
+    if hasattr(chunks, "__aiter__"):
+        async for chunk in chunks:
+            condenser.feed(chunk)
+    else:
+        # A blocking download (requests' iter_content) must not stall the loop.
+        chunks = iter(chunks)
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            condenser.feed(chunk)
+    return condenser
+
+
+# Model output of earlier generations; see darkly_cache.
+result_cache = ResultCache()
+
+# Split pages into segments of about this many characters, each generated and
+# cached on its own, so a revisit only regenerates the segments that changed.
+# 0 = off: the page is one generation.
+SEGMENT_CHARS = int(os.getenv("DARKLY_SEGMENT_CHARS", "0"))
+
+# With segments, generate up to this many of them at once. Output is still
+# streamed in document order; later segments are buffered until their turn.
+PARALLEL_SEGMENTS = max(1, int(os.getenv("DARKLY_PARALLEL_SEGMENTS", "1")))
+
+# Show the first this-many characters of the page text, plain and without
+# links, while the model has yet to produce anything; its first block hides
+# them. 0 = off.
+PREVIEW_CHARS = int(os.getenv("DARKLY_PREVIEW_CHARS", "0"))
+HINT_PREFIX_RE = re.compile(r'^\([A-Z0-9]+(?: hint:[^)]*)?\) ?')
+IMAGE_REF_RE = re.compile(r'!\[[^\]]*\]\[\d+\]')
+LINK_REF_RE = re.compile(r'\[([^\]]*)\]\[\d+\]')
+
+def _preview_html(condensed, limit):
+    """The top of the condensed text as escaped paragraphs, without hints, links or images."""
+    text = condensed[:limit]
+    if len(condensed) > limit and "\n" in text:
+        text = text[:text.rindex("\n")]  # whole lines only
+    paragraphs = []
+    for line in text.split("\n"):
+        line = LINK_REF_RE.sub(r'\1', IMAGE_REF_RE.sub('', HINT_PREFIX_RE.sub('', line))).strip()
+        if line:
+            paragraphs.append(f"<p>{html_lib.escape(line)}</p>\n")
+    return f'<div class="darkly-preview">\n{"".join(paragraphs)}</div>\n' if paragraphs else ""
+
+SEGMENT_INSTRUCTIONS = """
+* The content is one section of a longer page. Transform only this section: no title, preamble or closing remarks of your own."""
+
+
+def split_segments(condensed, target=None):
+    """Split condensed text into segments at content-defined line boundaries.
+
+    Whether a segment ends after a line depends on that line's text (and on the
+    running size), not on its position, so an inserted or edited line only
+    changes the segment it lands in and the boundaries after it resynchronize.
+    A line ends a segment with probability len(line) / target, which makes
+    segments about target characters long whatever the line lengths are.
+    """
+    target = target or SEGMENT_CHARS
+    if not target:
+        return [condensed]
+    segments, current, size = [], [], 0
+    for line in condensed.split("\n"):
+        current.append(line)
+        size += len(line) + 1
+        if size >= target * 4 or (size >= target // 4
+                                  and zlib.crc32(line.encode()) % target < len(line)):
+            segments.append("\n".join(current))
+            current, size = [], 0
+    if current:
+        segments.append("\n".join(current))
+    return segments
+
+
+class _Flight:
+    """One generation in progress, followed by every reader that wants it.
+
+    The chunks are kept, so a reader that joins late first catches up on what
+    was already generated and then follows live. Its model call waits for
+    admission at the best priority among its readers.
+    """
+
+    def __init__(self, priority):
+        self.priority = Priority(priority)
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self.task = None
+        self.changed = asyncio.Condition()
+
+    async def run(self, markdown_chunks, key, use_cache, stored_key=None):
+        try:
+            async for md_chunk in markdown_chunks:
+                self.chunks.append(md_chunk)
+                async with self.changed:
+                    self.changed.notify_all()
+            # Only a generation that ran to the end is stored: one that failed or
+            # whose readers all went away never gets here. stored_key() is None
+            # for one that is not to be kept.
+            stored = stored_key() if stored_key else key
+            if use_cache and self.chunks and stored:
+                result_cache.put(stored, "".join(self.chunks))
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            flights = _flights.get(asyncio.get_running_loop(), {})
+            if flights.get(key) is self:
+                del flights[key]
+            async with self.changed:
+                self.changed.notify_all()
+
+    async def follow(self, key):
+        self.readers += 1
+        sent = 0
+        reason = None
+        try:
+            while True:
+                while sent < len(self.chunks):
+                    sent += 1
+                    yield self.chunks[sent - 1]
+                if self.done:
+                    if self.error:
+                        raise self.error
+                    return
+                async with self.changed:
+                    await self.changed.wait_for(lambda: self.done or len(self.chunks) > sent)
+        except asyncio.CancelledError as e:
+            reason = _cancel_reason(e)
+            raise
+        finally:
+            self.readers -= 1
+            if not self.readers and not self.done:
+                # The last reader left: nobody wants the rest. Unregister first,
+                # so a request arriving now starts afresh instead of joining a
+                # generation that is being cancelled.
+                flights = _flights.get(asyncio.get_running_loop(), {})
+                if flights.get(key) is self:
+                    del flights[key]
+                self.task.cancel(reason)  # why the last reader left
+
+
+# Generations in progress: event loop -> {cache key: _Flight}. Identical
+# requests that arrive while one is running (several tabs or users opening the
+# same page) follow it instead of starting their own.
+_flights = weakref.WeakKeyDictionary()
+
+
+def _cached_segment(segment, instructions, routes):
+    """The cached Markdown for segment from the first of routes that wrote it, or None."""
+    for route in routes:
+        markdown_text = result_cache.get(cache_key(segment, instructions, route))
+        if markdown_text is not None:
+            return markdown_text
+    return None
+
+
+async def _generate_segment(client, model_name, instructions, segment, key, cached, use_cache,
+                            provider=None, output_ratio=None, priority=PRIORITY_DOCUMENT):
+    """Yield the model's Markdown for one segment: cached, in progress for
+    another reader, or generated and then cached."""
+    if cached is not None:
+        yield cached
+        return
+    flights = _flights.setdefault(asyncio.get_running_loop(), {})
+    flight = flights.get(key) if use_cache else None
+    if flight is None:
+        # Instructions first and alone in the system message, the page after
+        # it: providers cache prompt prefixes automatically, so the unchanging
+        # instructions are only processed in full on the first page.
+        messages = [{"role": "system", "content": instructions},
+                    {"role": "user", "content": f"Content to transform:\n{segment}"}]
+        flight = _Flight(priority)
+        answered = {}
+        markdown_chunks = _call_llm_stream(client, model_name, messages, provider,
+                                           _output_cap(segment, output_ratio), flight.priority,
+                                           answered)
+        # Cached as what it is: with hedging or routing, another provider or
+        # model than the one asked for may have written it. Readers that join
+        # still follow it, since they asked for the same thing. Output cut off
+        # at max_tokens is not the page, and is not cached at all.
+        def stored_key():
+            if answered.get("finish_reason") == "length":
+                return None
+            return cache_key(segment, instructions, answered["route"]) if "route" in answered else key
+        flight.task = asyncio.create_task(flight.run(markdown_chunks, key, use_cache, stored_key))
+        if use_cache:
+            flights[key] = flight
+    else:
+        print(f"Single-flight: joining a generation in progress ({len(flight.chunks)} chunks in)")
+        # A reader clicking a link that is still being prefetched must not
+        # wait behind every page and frame as background work.
+        flight.priority.raise_to(priority)
+    async for md_chunk in flight.follow(key):
+        yield md_chunk
+
+
+async def _render_segment(markdown_chunks, parser, out, limit):
+    """Render one segment's Markdown into out, a queue of HTML chunks.
+
+    Ends with None, or with the exception that stopped it. limit bounds how
+    many segments generate at once.
+    """
+    try:
+        async with limit:
+            async for md_chunk in markdown_chunks:
+                html_chunk = parser.process_chunk(md_chunk)
+                if html_chunk:
+                    out.put_nowait(html_chunk)
+            final_chunk = parser.finish()
+            if final_chunk:
+                out.put_nowait(final_chunk)
+    except Exception as e:
+        out.put_nowait(e)
+        return
+    out.put_nowait(None)
+
+
+async def simplify_html_stream(html_content, base_url="", proxy_prefix="", use_cache=True,
+                               priority=PRIORITY_DOCUMENT, preview=True):
+    """Stream the simplified page as HTML chunks.
+
+    html_content is the page as a string, or an iterable / async iterable of
+    text chunks. A stream is condensed as it arrives, so the model call starts
+    as soon as the last chunk does instead of after a separate condensing pass.
+    A page (or with DARKLY_SEGMENT_CHARS, a segment of one) already generated
+    with the same text, instructions and model is replayed from result_cache
+    unless use_cache is false. priority (see darkly_admission) orders the model
+    calls when a provider's admission limits are reached.
+
+    The page shell is sent before the page is even read, so the reader sees a
+    styled page at once. With DARKLY_PREVIEW_CHARS, the top of the page text
+    follows as soon as it is condensed, until the model's first block; callers
+    that buffer the whole page pass preview=False.
+    """
     if not html_content:
         yield "Error: No HTML content provided"
         return
 
-    client, model_name = _get_llm_client()
+    provider = os.getenv("AI_PROVIDER")
+    client, model_name = _get_llm_client(provider)
     if not client:
         yield "Error: Unsupported model type"
         return
 
-    print(f"Original HTML length: {len(html_content)}")
-    condensed, mapping = dom_to_condensed(html_content)
-    print(f"Condensed markdown length: {len(condensed)}, IDs mapped: {len(mapping)}")
-
-    prompt = f"{current_instructions}\n{PROTOCOL_INSTRUCTIONS}\n\nContent to transform:\n{condensed}"
-    parser = MarkdownStreamParser(mapping, base_url, proxy_prefix)
-    
     yield f"""<!DOCTYPE html>
 <html lang="en">
 <head>
@@ -470,6 +1610,7 @@ async def simplify_html_stream(html_content, base_url="", proxy_prefix=""):
         a:hover {{ border-color: var(--link); }}
         img {{ max-width: 100%; height: auto; border-radius: 0.5rem; margin: 1rem 0; box-shadow: 0 4px 6px -1px rgba(0,0,0,0.1); }}
         p {{ margin-bottom: 1.5rem; }}
+        .darkly-preview {{ opacity: 0.5; }}
         blockquote {{ border-left: 4px solid var(--accent); margin: 0; padding-left: 1rem; color: #737373; font-style: italic; }}
     </style>
 </head>
@@ -477,27 +1618,104 @@ async def simplify_html_stream(html_content, base_url="", proxy_prefix=""):
 <div class="darkly-content">
 """
 
+    token_budget = _token_budget()
+    if isinstance(html_content, str):
+        print(f"Original HTML length: {len(html_content)}")
+        condensed, mapping = dom_to_condensed(html_content, token_budget=token_budget, base_url=base_url)
+    else:
+        condenser = await _condense_chunks(html_content, base_url)
+        print(f"Original HTML length: {condenser.length} (streamed)")
+        if not condenser.length:
+            yield "Error: No HTML content provided\n</div></body></html>"
+            return
+        condensed, mapping = condenser.finish(token_budget)
+    references = len(ID_REF_RE.findall(condensed))
+    print(f"Condensed markdown length: {len(condensed)}, IDs mapped: {len(mapping)} "
+          f"(for {references} links/images)")
+
+    rule = _size_rule(condensed, mapping)
+    if rule:
+        rule_client, rule_model = _get_llm_client(rule.get("provider", provider))
+        if rule_client:
+            provider = rule.get("provider", provider)
+            client, model_name = rule_client, rule.get("model") or rule_model
+            print(f"Size rule: {provider}/{model_name}")
+        else:
+            print(f"Size rule names an unknown provider, ignored: {rule}")
+    output_ratio = rule.get("max_output_ratio", MAX_OUTPUT_RATIO)
+
+    instructions = f"{current_instructions}\n{PROTOCOL_INSTRUCTIONS}"
+    segments = split_segments(condensed)
+    if len(segments) > 1:
+        instructions += SEGMENT_INSTRUCTIONS
+    # A segment is cached under the route that wrote it: with routing or
+    # hedging, any of the eligible ones.
+    routes = [route for route, _, _ in _eligible_llms(client, model_name, provider)]
+    keys = [cache_key(segment, instructions, routes[0]) for segment in segments]
+    cached = [_cached_segment(segment, instructions, routes) if use_cache else None
+              for segment in segments]
+    hits = sum(1 for markdown_text in cached if markdown_text is not None)
+    if hits or len(segments) > 1:
+        print(f"Segments: {len(segments)}, {hits} replayed from the result cache")
+    waiting = preview and PREVIEW_CHARS and hits < len(segments)
+
+    # Every segment is rendered by its own task, at most PARALLEL_SEGMENTS
+    # generating at a time (the semaphore admits them in document order). The
+    # segment being shown streams live; the ones after it fill their queues.
+    limit = asyncio.Semaphore(PARALLEL_SEGMENTS)
+    queues, tasks = [], []
+    for segment, key, markdown_text in zip(segments, keys, cached):
+        # A parser per segment: the segment's end is a block boundary, and a
+        # fence wrapping one segment's output is stripped like a page's. They
+        # all share the page's id mapping.
+        parser = MarkdownStreamParser(mapping, base_url, proxy_prefix)
+        markdown_chunks = _generate_segment(client, model_name, instructions, segment, key,
+                                            markdown_text, use_cache, provider, output_ratio,
+                                            priority)
+        queues.append(asyncio.Queue())
+        tasks.append(asyncio.create_task(_render_segment(markdown_chunks, parser, queues[-1], limit)))
+    reason = None
     try:
-        async for md_chunk in _call_llm_stream(client, model_name, prompt):
-            html_chunk = parser.process_chunk(md_chunk)
-            if html_chunk:
+        if waiting:
+            yield _preview_html(condensed, PREVIEW_CHARS)  # the generations have started
+        for out in queues:
+            while (html_chunk := await out.get()) is not None:
+                if isinstance(html_chunk, Exception):
+                    raise html_chunk
+                if waiting:
+                    waiting = False
+                    yield "<style>.darkly-preview { display: none; }</style>\n"
                 yield html_chunk
+    except asyncio.CancelledError as e:
+        reason = _cancel_reason(e)
+        raise
+    except GeneratorExit:
+        reason = READER_GONE  # the caller stopped reading
+        raise
+    finally:
+        # The reader went away or a segment failed: stop the other generations.
+        for task in tasks:
+            task.cancel(reason)
 
-        final_chunk = parser.finish()
-        if final_chunk:
-            yield final_chunk
+    yield "\n</div></body></html>"
 
-        yield "\n</div></body></html>"
-    finally:
-        # Each call builds its own client (and httpx connection pool). Without
-        # this the pool is still open when the caller's event loop closes.
-        await client.close()
+DISCONNECT_POLL = 0.5  # seconds between checks that the browser is still there
+
+def _client_gone(flow):
+    """Has the browser closed its connection (or mitmproxy failed the flow)?"""
+    client = flow.client_conn
+    return (flow.error is not None or client.timestamp_end is not None
+            or not client.state & ConnectionState.CAN_READ)
 
 class DarklyAddon:
     def __init__(self):
         print("Darkly Proxy Addon Loaded")
         print("Control Panel available at http://dark.ly")
 
+    async def done(self):
+        # mitmproxy is shutting down: close the pooled LLM connections cleanly.
+        await close_llm_clients()
+
     async def request(self, flow: http.HTTPFlow):
         purpose = flow.request.headers.get("Sec-Purpose", flow.request.headers.get("Purpose", ""))
         if "prefetch" in purpose.lower():
@@ -580,10 +1798,30 @@ class DarklyAddon:
                 html_content = flow.response.get_text()
                 
                 chunks = []
-                # Buffer the stream. Mitmproxy requires the full string assigned to response.set_text()
-                async for chunk in simplify_html_stream(html_content, flow.request.scheme + "://" + flow.request.pretty_host, ""):
-                    chunks.append(chunk)
-                
+
+                async def collect():
+                    # Buffer the stream. Mitmproxy requires the full string assigned to response.set_text()
+                    async for chunk in simplify_html_stream(html_content, flow.request.scheme + "://" + flow.request.pretty_host, "",
+                                                            priority=priority_for_dest(dest), preview=False):
+                        chunks.append(chunk)
+
+                # Nothing is sent before the page is complete, so a browser that
+                # gave up (navigated on, closed the tab) is only noticed by
+                # watching its connection. Then the generation is cancelled.
+                generation = asyncio.create_task(collect())
+                reason = None
+                try:
+                    while not (await asyncio.wait([generation], timeout=DISCONNECT_POLL))[0]:
+                        if _client_gone(flow):
+                            print(f"Client went away, cancelled: {flow.request.pretty_url}")
+                            reason = READER_GONE
+                            if flow.killable:
+                                flow.kill()
+                            return
+                    generation.result()
+                finally:
+                    generation.cancel(reason)  # no-op once it has finished
+
                 full_html = "".join(chunks)
                 flow.response.set_text(full_html)
                 flow.response.headers["Content-Length"] = str(len(flow.response.raw_content))
@@ -0,0 +1,173 @@
+"""Admission control for LLM calls: concurrency and rate limits per provider.
+
+Without it, every page opens its provider stream at once, and a burst of
+navigations runs into the provider's rate limits (429), which fails whole
+pages. A ProviderGate holds calls back instead: at most max_concurrent streams
+at a time, and token buckets for requests and prompt tokens per minute. Waiting
+calls are admitted by priority, then in arrival order, so what the user is
+looking at goes first.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+
+# Lower goes first.
+PRIORITY_DOCUMENT = 0    # top-level navigation
+PRIORITY_FRAME = 1       # iframe/frame loads
+PRIORITY_BACKGROUND = 2  # work nobody is waiting for (prefetch, probes)
+
+PRIORITY_NAMES = {PRIORITY_DOCUMENT: "document", PRIORITY_FRAME: "frame",
+                  PRIORITY_BACKGROUND: "background"}
+
+BURST_SECONDS = 10  # a bucket holds this many seconds' worth of its rate
+
+
+class Priority:
+    """A call's priority that can still be raised while it waits for admission,
+    e.g. when a reader joins a generation a prefetch started. Gates accept it
+    wherever they accept a plain priority."""
+
+    def __init__(self, value):
+        self.value = value
+        self._gates = set()  # gates it is queued in
+
+    def raise_to(self, value):
+        if value < self.value:
+            self.value = value
+            for gate in list(self._gates):
+                gate._resort()
+
+
+def priority_for_dest(dest):
+    """Priority for a request's Sec-Fetch-Dest (None: no header, assume a navigation)."""
+    return PRIORITY_FRAME if dest in ("iframe", "frame") else PRIORITY_DOCUMENT
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * BURST_SECONDS)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost):
+        """Seconds until cost can be taken (0 = now). A cost bigger than the
+        bucket is let through once it is full, and leaves it in debt."""
+        self._refill()
+        missing = min(cost, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, cost):
+        self._refill()
+        self.tokens -= cost
+
+
+class ProviderGate:
+    """Admission for one provider's calls on one event loop."""
+
+    def __init__(self, name, max_concurrent=None, requests_per_minute=None,
+                 tokens_per_minute=None):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.in_flight = 0
+        self.admitted = 0
+        self._waiting = []  # heap of (priority, seq, future, cost, Priority or None)
+        self._seq = itertools.count()
+        self._timer = None
+        self._waits = deque(maxlen=100)  # recent wait times, seconds
+
+    def _unlimited(self):
+        return not (self.max_concurrent or self.requests or self.tokens)
+
+    async def acquire(self, priority=PRIORITY_DOCUMENT, cost=1):
+        """Wait for a slot. cost is the call's estimated prompt tokens. Pair with release()."""
+        start = time.monotonic()
+        if self._unlimited():
+            self._admit(cost)
+            return 0.0
+        ticket = priority if isinstance(priority, Priority) else None
+        if ticket:
+            priority = ticket.value
+            ticket._gates.add(self)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), future, cost, ticket))
+        self._pump()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # admitted just as the caller gave up
+            raise
+        finally:
+            if ticket:
+                ticket._gates.discard(self)
+        waited = time.monotonic() - start
+        self._waits.append(waited)
+        return waited
+
+    def release(self):
+        self.in_flight -= 1
+        self._pump()
+
+    def _admit(self, cost):
+        self.in_flight += 1
+        self.admitted += 1
+        if self.requests:
+            self.requests.take(1)
+        if self.tokens:
+            self.tokens.take(cost)
+
+    def _pump(self):
+        """Admit waiting calls, best priority first, while the limits allow."""
+        while self._waiting:
+            priority, _, future, cost, _ = self._waiting[0]
+            if future.done():  # the caller gave up
+                heapq.heappop(self._waiting)
+                continue
+            if self.max_concurrent and self.in_flight >= self.max_concurrent:
+                return  # release() pumps again
+            delay = max(self.requests.wait_time(1) if self.requests else 0,
+                        self.tokens.wait_time(cost) if self.tokens else 0)
+            if delay > 0:
+                # The head waits for its tokens; nothing jumps ahead of it.
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+                return
+            heapq.heappop(self._waiting)
+            self._admit(cost)
+            future.set_result(None)
+
+    def _resort(self):
+        """A queued call's Priority was raised."""
+        self._waiting = [(ticket.value if ticket else priority, seq, future, cost, ticket)
+                         for priority, seq, future, cost, ticket in self._waiting]
+        heapq.heapify(self._waiting)
+        self._pump()
+
+    def _wake(self):
+        self._timer = None
+        self._pump()
+
+    def snapshot(self):
+        queued = {}
+        for priority, _, future, _, _ in self._waiting:
+            if not future.done():
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                queued[name] = queued.get(name, 0) + 1
+        waits = list(self._waits)
+        return {
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "queued": queued,
+            "avg_wait": round(sum(waits) / len(waits), 3) if waits else None,
+            "max_wait": round(max(waits), 3) if waits else None,
+        }
@@ -0,0 +1,92 @@
+"""Cache of model output for pages that have already been simplified.
+
+The key is everything the model's answer depends on: the condensed page text,
+the instructions it was given and the provider/model. Editing the instructions
+therefore misses naturally, and so does a page whose text changed.
+
+What is stored is the model's Markdown, not the rendered HTML: the [text][id]
+references are resolved against the current page's mapping on replay, so the
+same text with different link targets (session tokens in query strings, another
+proxy prefix) still renders correctly.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+CACHE_SIZE = int(os.getenv("DARKLY_CACHE_SIZE", "256"))
+CACHE_DIR = os.getenv("DARKLY_CACHE_DIR", "")
+
+
+def _digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def cache_key(condensed, instructions, model):
+    """Key for a generation: hashes of the page text and instructions, plus the model."""
+    return _digest(f"{_digest(condensed)}\n{_digest(instructions)}\n{model}")
+
+
+class ResultCache:
+    """A bounded in-memory LRU, backed by an optional directory of files.
+
+    The disk tier survives restarts and is not size-limited; clear it by
+    deleting the directory. max_entries=0 turns the memory tier off.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE, directory=CACHE_DIR):
+        self.max_entries = max_entries
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()  # the server's threads share one cache
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                return value
+        value = self._read(key)
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self._remember(key, value)
+        self._write(key, value)
+
+    def _remember(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.md")
+
+    def _read(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, key, value):
+        if not self.directory:
+            return
+        # Write-then-rename, so a concurrent reader never sees half a file.
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Result cache: cannot write {path}: {e}")
@@ -6,6 +6,8 @@ Usage:
 Saves outputs to comparison/{slug}/{label}.html and prints a timing summary.
 The "kept" column is the fraction of the condensed input text that survives into
 the model's output -- the number to watch for models that silently drop content.
+It is measured against the unfiltered condensed text, so running once with
+DARKLY_BOILERPLATE_FILTER=1 and once without shows what the filter costs.
 """
 import asyncio
 import os
@@ -87,11 +89,28 @@ def apply_env(env):
         os.environ[k] = v
 
 
+# What each run's label promises: its provider and model, with their full output.
+# Size rules, output caps, routing and hedging would each quietly swap the model
+# behind a run or cut it short, so they are off here whatever the .env says.
+PINNED_SETTINGS = {"SIZE_RULES": [], "MAX_OUTPUT_RATIO": None, "ROUTING": False, "HEDGE_DELAY": None}
+
+
 async def _collect(html, base_url):
-    """Drain simplify_html_stream into a single document."""
+    """Drain simplify_html_stream into a single document.
+
+    The result cache is bypassed: a replay would time nothing. So are the
+    settings in PINNED_SETTINGS.
+    """
+    for name, value in PINNED_SETTINGS.items():
+        setattr(darkly_addon, name, value)
     parts = []
-    async for chunk in darkly_addon.simplify_html_stream(html, base_url, ""):
-        parts.append(chunk)
+    try:
+        async for chunk in darkly_addon.simplify_html_stream(html, base_url, "", use_cache=False,
+                                                              preview=False):
+            parts.append(chunk)
+    finally:
+        # asyncio.run gives every call a fresh loop; close its pooled client.
+        await darkly_addon.close_llm_clients()
     return "".join(parts)
 
 
@@ -130,11 +149,15 @@ def main():
             continue
 
         # The condensed text is what the model actually sees, so it is the fair
-        # denominator for "how much content survived".
-        condensed, mapping = darkly_addon.dom_to_condensed(html)
-        baseline = len(visible_text(condensed))
+        # denominator for "how much content survived". Unfiltered, so that
+        # whatever the boilerplate filter removes also counts against "kept".
+        full, _ = darkly_addon.dom_to_condensed(html, boilerplate=False)
+        condensed, mapping = darkly_addon.dom_to_condensed(html, base_url=url)
+        baseline = len(visible_text(full))
         print(f"  fetched {len(html)} chars -> condensed {len(condensed)} chars, "
               f"{len(condensed.splitlines())} blocks, {len(mapping)} ids")
+        if darkly_addon.BOILERPLATE_FILTER:
+            print(f"  boilerplate filter: {len(full)} -> {len(condensed)} chars")
 
         with open(os.path.join(page_dir, "_original.html"), "w") as f:
             f.write(absolutize_urls(html, url))
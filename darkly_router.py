@@ -0,0 +1,123 @@
+"""Latency-aware choice between the configured LLM providers.
+
+Every generation reports how it went: time to first token and output rate on
+success, or the error. The router ranks providers by the latency a typical page
+would see from recent results, and keeps a circuit breaker per provider/model:
+after repeated failures, or at once for a model the provider no longer serves
+(404) or credentials it rejects (401/403), the circuit opens and real pages stop
+going there. Once its cooldown is over, the caller probes it with a tiny
+request in the background; the first success closes it again.
+"""
+import threading
+import time
+from collections import deque
+
+WINDOW = 20           # results remembered per provider/model
+STATS_TTL = 600       # seconds; older results are forgotten, so a provider that
+                      # was slow once gets measured again
+FAILURE_THRESHOLD = 3  # consecutive failures that open the circuit
+COOLDOWN = 30         # seconds before an open circuit is probed
+FATAL_COOLDOWN = 600  # same, after a 404/401/403
+TYPICAL_OUTPUT_TOKENS = 1000  # page length the ranking optimizes for
+
+FATAL_STATUSES = (401, 403, 404)
+
+
+class _Route:
+    def __init__(self):
+        self.results = deque(maxlen=WINDOW)  # (time, ok, ttft, tokens_per_sec)
+        self.failures = 0                    # consecutive
+        self.open_until = None               # set while the circuit is open
+        self.probing = False
+        self.last_error = None
+
+
+class Router:
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()  # snapshot() is read from server threads
+
+    def _route(self, name):
+        return self._routes.setdefault(name, _Route())
+
+    def record_success(self, name, ttft, tokens_per_sec):
+        with self._lock:
+            route = self._route(name)
+            route.results.append((time.time(), True, ttft, tokens_per_sec))
+            route.failures = 0
+            route.probing = False
+            if route.open_until is not None:
+                print(f"Router: {name} recovered, circuit closed")
+            route.open_until = None
+
+    def record_failure(self, name, error, status=None):
+        with self._lock:
+            route = self._route(name)
+            route.results.append((time.time(), False, None, None))
+            route.failures += 1
+            route.probing = False
+            route.last_error = str(error)
+            if status in FATAL_STATUSES:
+                cooldown = FATAL_COOLDOWN
+            elif route.failures >= FAILURE_THRESHOLD:
+                cooldown = COOLDOWN
+            else:
+                return
+            route.open_until = time.time() + cooldown
+            print(f"Router: circuit open for {name} ({cooldown}s) after: {error}")
+
+    def is_open(self, name):
+        route = self._routes.get(name)
+        return route is not None and route.open_until is not None
+
+    def score(self, name):
+        """Expected seconds for a typical page; 0 while unmeasured, so new
+        providers get tried. Failures inflate it by the expected retries."""
+        route = self._routes.get(name)
+        if route is None:
+            return 0.0
+        cutoff = time.time() - STATS_TTL
+        recent = [r for r in route.results if r[0] >= cutoff]
+        ok = [r for r in recent if r[1]]
+        if not ok:
+            return 0.0 if not recent else float("inf")
+        ttft = sum(r[2] for r in ok) / len(ok)
+        rate = sum(r[3] for r in ok) / len(ok)
+        expected = ttft + (TYPICAL_OUTPUT_TOKENS / rate if rate else 0)
+        return expected * len(recent) / len(ok)
+
+    def rank(self, names):
+        """names ordered best first. Open circuits go last, in case nothing else is left."""
+        with self._lock:
+            return sorted(names, key=lambda name: (self.is_open(name), self.score(name)))
+
+    def due_probes(self, names):
+        """Open circuits whose cooldown is over, marked as being probed."""
+        now = time.time()
+        due = []
+        with self._lock:
+            for name in names:
+                route = self._routes.get(name)
+                if (route and route.open_until is not None and not route.probing
+                        and now >= route.open_until):
+                    route.probing = True
+                    due.append(name)
+        return due
+
+    def snapshot(self):
+        """Per provider/model: score, breaker state and recent results, for display."""
+        with self._lock:
+            out = {}
+            for name, route in self._routes.items():
+                ok = [r for r in route.results if r[1]]
+                score = self.score(name)
+                out[name] = {
+                    "score": round(score, 3) if score != float("inf") else None,
+                    "circuit": "open" if route.open_until is not None else "closed",
+                    "results": len(route.results),
+                    "errors": len(route.results) - len(ok),
+                    "ttft": round(sum(r[2] for r in ok) / len(ok), 3) if ok else None,
+                    "tokens_per_sec": round(sum(r[3] for r in ok) / len(ok), 1) if ok else None,
+                    "last_error": route.last_error,
+                }
+            return out
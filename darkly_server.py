@@ -1,11 +1,27 @@
+import asyncio
+import atexit
+import functools
+import html
 import ipaddress
 import os
+import queue
+import re
+import select
 import socket
-from urllib.parse import urljoin, urlsplit
+import ssl
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import aclosing
+from urllib.parse import parse_qs, unquote, urljoin, urlsplit
 from dotenv import load_dotenv
 from flask import Flask, render_template, request, Response, jsonify
-import requests
-from darkly_addon import simplify_html_stream
+import httpcore
+import httpx
+from darkly_addon import (PRIORITY_BACKGROUND, READER_GONE, admission_snapshot, cancel_stats,
+                          close_llm_clients, generation_settings, hedge_stats, priority_for_dest,
+                          router, simplify_html_stream)
 
 load_dotenv()
 
@@ -15,12 +31,91 @@ USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
               '(KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36')
 FETCH_TIMEOUT = 20
 MAX_REDIRECTS = 5
+FETCH_CHUNK_SIZE = 16384
+DISCONNECT_POLL = 0.5  # seconds between checks that the reader is still there
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+    """The event loop every generation runs on, started on first use.
+
+    One long-lived loop (instead of one per request) is what lets the pooled
+    LLM clients in darkly_addon keep their connections between pages.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="darkly-loop", daemon=True).start()
+            atexit.register(_stop_loop)
+        return _loop
+
+
+async def _close_clients():
+    await close_llm_clients()
+    await close_origin_clients()
+
+
+def _stop_loop():
+    try:
+        asyncio.run_coroutine_threadsafe(_close_clients(), _loop).result(timeout=5)
+    finally:
+        _loop.call_soon_threadsafe(_loop.stop)
 
 
 class BlockedURL(Exception):
     """The requested URL is not one we are willing to fetch on a caller's behalf."""
 
 
+# Resolved addresses: host -> (expires, [ip, ...] or why it failed). The URL
+# check and the connection both read from here, so a page costs one lookup per
+# host, and the address connected to is always one that was checked: a DNS
+# answer cannot change between the two (rebinding). getaddrinfo reports no
+# record TTLs, so answers are kept DNS_TTL seconds and failures DNS_NEGATIVE_TTL.
+DNS_TTL = float(os.getenv("DARKLY_DNS_TTL", "60"))
+DNS_NEGATIVE_TTL = float(os.getenv("DARKLY_DNS_NEGATIVE_TTL", "10"))
+DNS_CACHE_SIZE = 1024
+
+_dns_cache = OrderedDict()
+_dns_lock = threading.Lock()  # checks run in worker threads
+
+
+def _resolve(host, port):
+    """host's addresses, cached. Raises BlockedURL if it does not resolve."""
+    now = time.time()
+    with _dns_lock:
+        entry = _dns_cache.get(host)
+        if entry and entry[0] <= now:
+            del _dns_cache[host]
+            entry = None
+    if entry is None:
+        try:
+            infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+            entry = (now + DNS_TTL, list(dict.fromkeys(info[4][0] for info in infos)))
+        except socket.gaierror as e:
+            entry = (now + DNS_NEGATIVE_TTL, f"Cannot resolve {host}: {e}")
+        with _dns_lock:
+            _dns_cache[host] = entry
+            while len(_dns_cache) > DNS_CACHE_SIZE:
+                _dns_cache.popitem(last=False)
+    if isinstance(entry[1], str):
+        raise BlockedURL(entry[1])
+    return entry[1]
+
+
+def _allowed_addresses(host, port):
+    """host's addresses, if all of them are public. Raises BlockedURL."""
+    addresses = _resolve(host, port)
+    for address in addresses:
+        ip = ipaddress.ip_address(address)
+        if not ip.is_global:
+            raise BlockedURL(f"Refusing to fetch non-public address {ip} ({host})")
+    return addresses
+
+
 def _check_url_allowed(url):
     """Reject anything but public http(s). Raises BlockedURL.
 
@@ -37,127 +132,459 @@ def _check_url_allowed(url):
         raise BlockedURL("URL has no host")
 
     port = parts.port or (443 if parts.scheme == 'https' else 80)
-    try:
-        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
-    except socket.gaierror as e:
-        raise BlockedURL(f"Cannot resolve {host}: {e}")
+    _allowed_addresses(host, port)
 
-    for info in infos:
-        ip = ipaddress.ip_address(info[4][0])
-        if not ip.is_global:
-            raise BlockedURL(f"Refusing to fetch non-public address {ip} ({host})")
+
+# Origin connections, pooled like the LLM clients' (see darkly_addon): a
+# repeat fetch from a site skips DNS, TCP and TLS. At most ORIGIN_PER_HOST
+# connections go to one host at a time, as a browser would, so a burst of
+# readers (and prefetches) cannot hammer a single site.
+ORIGIN_POOL_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("DARKLY_ORIGIN_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("DARKLY_ORIGIN_MAX_KEEPALIVE", "20")),
+    keepalive_expiry=float(os.getenv("DARKLY_ORIGIN_KEEPALIVE_EXPIRY", "60")),
+)
+ORIGIN_PER_HOST = int(os.getenv("DARKLY_ORIGIN_PER_HOST", "6"))
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """A response body that gives back its host slot when closed."""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release:
+                self._release()
+                self._release = None
+
+
+class _PerHostLimit(httpx.AsyncBaseTransport):
+    """Hold each host to per_host responses open at once; more wait their turn.
+
+    A slot is held from the request until its response is closed, which for a
+    streamed page is when it has finished downloading.
+    """
+
+    def __init__(self, transport, per_host, timeout):
+        self._transport = transport
+        self._per_host = per_host
+        self._timeout = timeout
+        self._slots = {}  # host -> [semaphore, users]
+
+    async def handle_async_request(self, request):
+        host = request.url.host
+        slot = self._slots.setdefault(host, [asyncio.Semaphore(self._per_host), 0])
+        slot[1] += 1
+        try:
+            await asyncio.wait_for(slot[0].acquire(), self._timeout)
+        except asyncio.TimeoutError:
+            self._leave(host, slot)
+            raise httpx.PoolTimeout(f"No free connection to {host} after {self._timeout}s",
+                                    request=request) from None
+        except BaseException:
+            self._leave(host, slot)
+            raise
+        release = functools.partial(self._release, host, slot)
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            release()
+            raise
+        response.stream = _ReleasingStream(response.stream, release)
+        return response
+
+    def _release(self, host, slot):
+        slot[0].release()
+        self._leave(host, slot)
+
+    def _leave(self, host, slot):
+        slot[1] -= 1
+        if not slot[1]:
+            del self._slots[host]
+
+    async def aclose(self):
+        await self._transport.aclose()
 
 
-def fetch_page(url):
-    """Fetch url, validating every hop. Returns (response, final_url).
+class _PinnedBackend(httpcore.AsyncNetworkBackend):
+    """Connect to the checked addresses of a host, never to a fresh lookup.
 
-    Redirects are followed manually because requests would otherwise happily
+    TLS still verifies the certificate against the host name.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        addresses = await asyncio.to_thread(_allowed_addresses, host, port)
+        for i, address in enumerate(addresses):
+            try:
+                return await self._backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except httpcore.ConnectError:
+                if i == len(addresses) - 1:
+                    raise
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise BlockedURL("Refusing to connect to a Unix socket")
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+# Long-lived origin clients: event loop -> httpx.AsyncClient.
+_origin_clients = weakref.WeakKeyDictionary()
+
+
+def _origin_client():
+    """The pooled origin client of the running loop."""
+    loop = asyncio.get_running_loop()
+    client = _origin_clients.get(loop)
+    if client is None:
+        pool = httpx.AsyncHTTPTransport(limits=ORIGIN_POOL_LIMITS)
+        # httpx has no option for the network backend: wrap the pool's own.
+        pool._pool._network_backend = _PinnedBackend(pool._pool._network_backend)
+        # trust_env=False: an HTTP(S)_PROXY would resolve the host again itself.
+        client = httpx.AsyncClient(transport=_PerHostLimit(pool, ORIGIN_PER_HOST, FETCH_TIMEOUT),
+                                   headers={'User-Agent': USER_AGENT}, timeout=FETCH_TIMEOUT,
+                                   trust_env=False)
+        _origin_clients[loop] = client
+    return client
+
+
+async def close_origin_clients():
+    """Close the running loop's origin client. Call before the loop shuts down."""
+    client = _origin_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def fetch_page(url):
+    """Fetch url, validating every hop. Returns (response, final_url). Runs on the loop.
+
+    Redirects are followed manually because the client would otherwise happily
     follow a public URL's 302 into a private address, bypassing the check above.
+    The body is not read yet: use await response.aread(), or iter_text(response)
+    to process it while it downloads, or await response.aclose() to drop it.
     """
+    client = _origin_client()
     for _ in range(MAX_REDIRECTS + 1):
-        _check_url_allowed(url)
-        response = requests.get(url, headers={'User-Agent': USER_AGENT},
-                                timeout=FETCH_TIMEOUT, allow_redirects=False)
-        if response.is_redirect or response.is_permanent_redirect:
+        await asyncio.to_thread(_check_url_allowed, url)
+        response = await client.send(client.build_request('GET', url), stream=True)
+        if response.is_redirect:
             location = response.headers.get('Location')
-            response.close()
+            await response.aread()  # a drained connection goes back to the pool
             if not location:
                 raise BlockedURL("Redirect without a Location header")
             url = urljoin(url, location)
             continue
-        response.raise_for_status()
+        if response.is_error:
+            await response.aclose()
+            response.raise_for_status()
         return response, url
     raise BlockedURL(f"Exceeded {MAX_REDIRECTS} redirects")
 
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+async def iter_text(response):
+    """Yield a streamed response's body as text, decoded like response.text."""
+    try:
+        async for text in response.aiter_text(FETCH_CHUNK_SIZE):
+            yield text
+    finally:
+        await response.aclose()
 
-@app.route('/proxy')
-async def proxy():
-    url = request.args.get('url')
 
-    if not url:
-        return "No URL provided", 400
+# Predictive prefetch (opt-in): after a page is served, the first
+# DARKLY_PREFETCH_LINKS links of the simplified page are fetched and simplified
+# in the background, so a click on one within PREFETCH_SERVE_TTL is served the
+# finished page. The simplified page's links are the ones the model kept: main
+# content, in reading order, with navigation and boilerplate already gone.
+PREFETCH_LINKS = int(os.getenv("DARKLY_PREFETCH_LINKS", "0"))
+PREFETCH_QUEUE_SIZE = 50
+PREFETCH_TTL = 600     # seconds before a prefetched URL is considered again
+PREFETCH_SERVE_TTL = 120  # seconds a prefetched page is served as it was generated
+PREFETCH_IDLE_POLL = 0.5
 
-    dest = request.headers.get('Sec-Fetch-Dest')
-    purpose = request.headers.get('Sec-Purpose', request.headers.get('Purpose', ''))
+PROXIED_LINK_RE = re.compile(r'href="/proxy\?url=([^"]+)"')
+PAGE_END = "\n</div></body></html>"  # simplify_html_stream's last chunk for a finished page
+
+# All prefetch state lives on the loop's thread.
+_prefetch_queue = deque(maxlen=PREFETCH_QUEUE_SIZE)
+_prefetched = OrderedDict()  # url -> time queued
+# The finished pages, by the URL a click would ask for and the one it ended up
+# at. The result cache alone is not enough: a page whose markup changes between
+# fetches (timestamps, tokens, ads) would miss it and be generated again. A page
+# is only served while the instructions and model it was made with are current.
+# Written on the loop; the Flask view only reads it.
+_prefetched_pages = OrderedDict()  # url -> (time finished, generation_settings(), simplified page)
+_prefetch_task = None
+_active_pages = 0            # pages being generated for a reader right now
+
+
+def _proxied_links(chunk):
+    """Target URLs of the /proxy links in a chunk of simplified HTML.
+
+    The parser emits whole blocks, so a link is never split across chunks.
+    """
+    return [unquote(html.unescape(target)) for target in PROXIED_LINK_RE.findall(chunk)]
+
+
+def _keep_prefetched(urls, settings, page):
+    now = time.time()
+    for url in urls:
+        _prefetched_pages.pop(url, None)
+        _prefetched_pages[url] = (now, settings, page)
+    while _prefetched_pages and (len(_prefetched_pages) > PREFETCH_QUEUE_SIZE or
+                                 next(iter(_prefetched_pages.values()))[0] < now - PREFETCH_SERVE_TTL):
+        _prefetched_pages.popitem(last=False)
+
+
+def _prefetched_page(url):
+    """The simplified page a recent prefetch of url produced, or None."""
+    entry = _prefetched_pages.get(url)
+    if entry and entry[0] >= time.time() - PREFETCH_SERVE_TTL and entry[1] == generation_settings():
+        return entry[2]
+    return None
+
+
+def _queue_prefetch(urls):
+    """Queue the first PREFETCH_LINKS of urls not prefetched recently. Runs on the loop."""
+    global _prefetch_task
+    now = time.time()
+    while _prefetched and next(iter(_prefetched.values())) < now - PREFETCH_TTL:
+        _prefetched.popitem(last=False)
+    picked = []
+    for url in urls:
+        if len(picked) >= PREFETCH_LINKS:
+            break
+        if url in _prefetched or urlsplit(url).scheme not in ('http', 'https'):
+            continue
+        _prefetched[url] = now
+        picked.append(url)
+    _prefetch_queue.extend(picked)
+    if _prefetch_queue and _prefetch_task is None:
+        _prefetch_task = asyncio.get_running_loop().create_task(_prefetch_worker())
+
+
+async def _prefetch_worker():
+    """Prefetch queued URLs one at a time, only while no reader's page is generating."""
+    global _prefetch_task
+    try:
+        while _prefetch_queue:
+            if _active_pages:
+                await asyncio.sleep(PREFETCH_IDLE_POLL)
+                continue
+            await _prefetch(_prefetch_queue.popleft())
+    finally:
+        _prefetch_task = None
+
+
+async def _prefetch(url):
+    response = None
+    try:
+        response, final_url = await fetch_page(url)
+        if 'text/html' not in response.headers.get('Content-Type', ''):
+            return
+        start = time.time()
+        settings = generation_settings()  # as they were when the generation started
+        chunks = [chunk async for chunk in simplify_html_stream(
+            iter_text(response), final_url, "/proxy?url=", priority=PRIORITY_BACKGROUND, preview=False)]
+        if chunks and chunks[-1] == PAGE_END:  # ran to the end, not an early "Error: ..."
+            _keep_prefetched({url, final_url}, settings, "".join(chunks))
+        print(f"Prefetched {url} in {time.time() - start:.2f}s")
+    except Exception as e:
+        print(f"Prefetch failed for {url}: {e}")
+    finally:
+        if response is not None:
+            await response.aclose()  # the generation may have stopped before reading it
+
+
+def _client_disconnected(sock):
+    """Has the client closed its end of sock? A readable socket with nothing to
+    read is at EOF. Only works for a plain socket (the development server
+    exposes it as environ["werkzeug.socket"]); None or TLS: unknown, False."""
+    if sock is None or isinstance(sock, ssl.SSLSocket):
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+    except (OSError, ValueError):
+        return True
+
+
+# Browsers label what each request is for (Sec-Fetch-Dest). Only a navigation
+# earns a generation call: HTML requested as a subresource (an <img> whose id
+# mapped to a page, an extension scanning links) would otherwise burn a full LLM
+# run per request. Refusing outright also avoids serving third-party HTML raw
+# from our origin, where an <object>/<embed> subresource would execute it
+# same-origin.
+NAVIGATION_DESTS = (None, 'document', 'iframe', 'frame')
+
+
+def _proxy_target(url, dest, purpose):
+    """Vet a /proxy request before anything is fetched.
+
+    Returns (url, None), or (None, (message, status)) to refuse it.
+    """
+    if not url:
+        return None, ("No URL provided", 400)
     print(f"/proxy dest={dest or '-'} purpose={purpose or '-'} url={url}")
 
     if 'prefetch' in purpose.lower():
         # Speculative fetch: refuse before spending anything. Browsers discard
         # failed prefetches and re-request normally on a real navigation.
-        return "Prefetch declined", 503
+        return None, ("Prefetch declined", 503)
 
     # Bare input like "example.com" or "example.com:8080/x" gets a default scheme.
     # Anything that already names a scheme keeps it, so _check_url_allowed can reject it.
     if '://' not in url:
         url = 'https://' + url
+    return url, None
+
+
+def _fetch_error(e):
+    """(message, status) for a failed fetch."""
+    if isinstance(e, BlockedURL):
+        return f"Blocked: {str(e)}", 403
+    if isinstance(e, httpx.TimeoutException):
+        return f"Timed out fetching page: {str(e)}", 504
+    if isinstance(e, httpx.HTTPError):
+        return f"Error fetching page: {str(e)}", 502
+    return f"Error processing page: {str(e)}", 500
+
 
+def _reader_priority(dest, site):
+    """Priority for a reader's page. Our own shell shows pages in its result frame, so a
+    same-origin frame is the reader's document, not an embed."""
+    if dest in ("iframe", "frame") and site == "same-origin":
+        return priority_for_dest(None)
+    return priority_for_dest(dest)
+
+
+async def _simplified_page(html_content, url, priority):
+    """A reader's simplified page, after which its links are queued for prefetch. Runs on the loop."""
+    global _active_pages
+    _active_pages += 1
+    links = []
+    try:
+        async for chunk in simplify_html_stream(html_content, url, "/proxy?url=",
+                                                priority=priority):
+            if PREFETCH_LINKS:
+                links.extend(_proxied_links(chunk))
+            yield chunk
+        if links:
+            _queue_prefetch(links)
+    except Exception as e:
+        yield f"Error streaming: {str(e)}"
+    finally:
+        _active_pages -= 1
+
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+# A plain view on purpose: Flask runs an async one through asgiref, which starts
+# a thread and a fresh event loop per request. The generation itself runs on
+# the shared loop from _get_loop().
+@app.route('/proxy')
+def proxy():
+    dest = request.headers.get('Sec-Fetch-Dest')
+    purpose = request.headers.get('Sec-Purpose', request.headers.get('Purpose', ''))
+    url, refusal = _proxy_target(request.args.get('url'), dest, purpose)
+    if refusal:
+        return refusal
+    if dest in NAVIGATION_DESTS and (page := _prefetched_page(url)):
+        print(f"Serving the prefetched page: {url}")
+        return Response(page, mimetype='text/html')
+
+    loop = _get_loop()
     try:
         # Follow redirects ourselves so each hop is checked against the allowlist.
-        response, url = fetch_page(url)
+        response, url = asyncio.run_coroutine_threadsafe(fetch_page(url), loop).result()
 
         content_type = response.headers.get('Content-Type', '')
 
         # If not HTML, return as is (binary content)
         if 'text/html' not in content_type:
-            return Response(response.content, mimetype=content_type)
-
-        # Browsers label what each request is for (Sec-Fetch-Dest). Only a
-        # navigation earns a generation call: HTML requested as a subresource
-        # (an <img> whose id mapped to a page, an extension scanning links)
-        # would otherwise burn a full LLM run per request. Refusing outright
-        # also avoids serving third-party HTML raw from our origin, where an
-        # <object>/<embed> subresource would execute it same-origin.
-        if dest not in (None, 'document', 'iframe', 'frame'):
-            return "HTML is only simplified for navigations", 415
-
-        html_content = response.text
-
-        # Use AI to simplify the HTML and stream the response
-        def generate():
-            import asyncio
-            import queue
-            import threading
-            
-            q = queue.Queue()
-            
-            def run_loop():
-                async def fetch():
-                    try:
-                        async for chunk in simplify_html_stream(html_content, url, "/proxy?url="):
-                            q.put(chunk)
-                    except Exception as e:
-                        q.put(f"Error streaming: {str(e)}")
-                    finally:
-                        q.put(None)
-                
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                try:
-                    loop.run_until_complete(fetch())
-                finally:
-                    loop.run_until_complete(loop.shutdown_asyncgens())
-                    loop.close()
-                
-            threading.Thread(target=run_loop, daemon=True).start()
-            
+            body = asyncio.run_coroutine_threadsafe(response.aread(), loop).result()
+            return Response(body, mimetype=content_type)
+    except Exception as e:
+        return _fetch_error(e)
+
+    if dest not in NAVIGATION_DESTS:
+        asyncio.run_coroutine_threadsafe(response.aclose(), loop)
+        return "HTML is only simplified for navigations", 415
+
+    # Handed over unread: the page is condensed while it downloads.
+    html_content = iter_text(response)
+    priority = _reader_priority(dest, request.headers.get('Sec-Fetch-Site'))
+    client_socket = request.environ.get('werkzeug.socket')
+
+    # Use AI to simplify the HTML and stream the response
+    def generate():
+        q = queue.Queue()
+        task = None
+
+        async def fetch():
+            nonlocal task
+            task = asyncio.current_task()
+            try:
+                async for chunk in _simplified_page(html_content, url, priority):
+                    q.put(chunk)
+            finally:
+                q.put(None)
+
+        future = asyncio.run_coroutine_threadsafe(fetch(), loop)
+
+        # A reader that goes away (navigated on, closed the tab) must stop
+        # the generation, not leave it running into the queue. A failed
+        # write closes this generator; during a long wait for the model,
+        # the socket is checked for EOF instead.
+        finished = False
+        try:
             while True:
-                chunk = q.get()
+                try:
+                    chunk = q.get(timeout=DISCONNECT_POLL)
+                except queue.Empty:
+                    if _client_disconnected(client_socket):
+                        print(f"Client went away, cancelling: {url}")
+                        break
+                    continue
                 if chunk is None:
+                    finished = True
                     break
                 yield chunk
-                
-        return Response(generate(), mimetype='text/html')
-            
-    except BlockedURL as e:
-        return f"Blocked: {str(e)}", 403
-    except requests.RequestException as e:
-        return f"Error fetching page: {str(e)}", 502
-    except Exception as e:
-        return f"Error processing page: {str(e)}", 500
+        finally:
+            if not finished:
+                # Through the task, with why: only a reader going away counts
+                # as saved output (see darkly_addon.cancel_stats).
+                loop.call_soon_threadsafe(lambda: task.cancel(READER_GONE) if task else future.cancel())
+            # Always: also stops a download still in progress, and the
+            # generation may have ended without reading the body at all.
+            asyncio.run_coroutine_threadsafe(response.aclose(), loop)
+
+    # The body may never be iterated either (HEAD, a failed write before the
+    # first chunk); until the origin response is closed, it holds one of its
+    # host's ORIGIN_PER_HOST slots.
+    served = Response(generate(), mimetype='text/html')
+    served.call_on_close(lambda: asyncio.run_coroutine_threadsafe(response.aclose(), loop))
+    return served
+
+@app.route('/api/providers')
+def provider_stats():
+    """Recent latency, errors and circuit state per provider/model, hedge results,
+    and admission queues per provider."""
+    return jsonify({"routes": router.snapshot(), "hedge_wins_losses": hedge_stats,
+                    "admission": admission_snapshot(), "cancelled": cancel_stats})
 
 @app.route('/api/instructions', methods=['GET', 'POST'])
 def handle_instructions():
@@ -177,6 +604,115 @@ def handle_instructions():
         "default": darkly_addon.DEFAULT_INSTRUCTIONS
     })
 
+
+# ASGI serving mode: uvicorn darkly_server:asgi_app
+#
+# /proxy then streams from the ASGI server's own event loop: no thread, queue
+# or socket polling per request, so a page being generated costs one task and
+# every page shares the pooled LLM clients of that one loop. Every other route
+# is the Flask app above, run in a worker thread by asgiref's WsgiToAsgi.
+
+_flask_asgi = None
+
+
+async def asgi_app(scope, receive, send):
+    global _flask_asgi
+    if scope["type"] == "lifespan":
+        await _asgi_lifespan(receive, send)
+    elif scope["type"] == "http" and scope["path"] == "/proxy":
+        await _asgi_proxy(scope, receive, send)
+    else:
+        if _flask_asgi is None:
+            from asgiref.wsgi import WsgiToAsgi  # pip install asgiref
+            _flask_asgi = WsgiToAsgi(app)
+        await _flask_asgi(scope, receive, send)
+
+
+async def _asgi_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await _close_clients()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def _asgi_respond(send, body, status=200, content_type='text/plain; charset=utf-8'):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode("latin-1"))]})
+    await send({"type": "http.response.body",
+                "body": body.encode() if isinstance(body, str) else body})
+
+
+async def _asgi_proxy(scope, receive, send):
+    args = parse_qs(scope["query_string"].decode("latin-1"))
+    headers = {name.decode("latin-1").lower(): value.decode("latin-1")
+               for name, value in scope["headers"]}
+    dest = headers.get('sec-fetch-dest')
+    purpose = headers.get('sec-purpose', headers.get('purpose', ''))
+    url, refusal = _proxy_target(args.get('url', [None])[0], dest, purpose)
+    if refusal:
+        await _asgi_respond(send, *refusal)
+        return
+    if dest in NAVIGATION_DESTS and (page := _prefetched_page(url)):
+        print(f"Serving the prefetched page: {url}")
+        await _asgi_respond(send, page, 200, 'text/html; charset=utf-8')
+        return
+
+    try:
+        response, url = await fetch_page(url)
+        content_type = response.headers.get('Content-Type', '')
+        if 'text/html' not in content_type:
+            body = await response.aread()
+            await _asgi_respond(send, body, 200, content_type)
+            return
+    except Exception as e:
+        await _asgi_respond(send, *_fetch_error(e))
+        return
+
+    if dest not in NAVIGATION_DESTS:
+        await response.aclose()
+        await _asgi_respond(send, "HTML is only simplified for navigations", 415)
+        return
+
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"text/html; charset=utf-8")]})
+    page = asyncio.ensure_future(_asgi_send_page(send, _simplified_page(
+        iter_text(response), url, _reader_priority(dest, headers.get('sec-fetch-site')))))
+    gone = asyncio.ensure_future(_asgi_disconnected(receive))
+    reason = None
+    try:
+        # A reader that goes away stops the generation, also while the model
+        # has yet to produce anything.
+        await asyncio.wait((page, gone), return_when=asyncio.FIRST_COMPLETED)
+        if not page.done():
+            print(f"Client went away, cancelling: {url}")
+            reason = READER_GONE
+    finally:
+        page.cancel(reason)
+        gone.cancel()
+        await asyncio.gather(page, gone, return_exceptions=True)
+        await response.aclose()  # also stops a download still in progress
+
+
+async def _asgi_send_page(send, chunks):
+    async with aclosing(chunks):
+        try:
+            async for chunk in chunks:
+                await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        except OSError:
+            pass  # the connection dropped mid-write
+
+
+async def _asgi_disconnected(receive):
+    """Returns once the client has disconnected."""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
 if __name__ == '__main__':
     # debug must stay off by default: the Werkzeug debugger exposes an interactive
     # console (and the API keys in os.environ) to anyone who can trigger a traceback.
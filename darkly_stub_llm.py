@@ -0,0 +1,225 @@
+"""A local stand-in for an LLM provider, for offline runs, benchmarks and load tests.
+
+Speaks the part of the OpenAI chat-completions API that darkly uses (streamed
+or not, with usage), with scripted latency instead of a real model:
+
+    python darkly_stub_llm.py --profile typical --mode echo
+
+then run the server or proxy with AI_PROVIDER=stub (STUB_BASE_URL defaults to
+this server's default address).
+
+Output modes: "echo" returns the page text it was sent (already Markdown with
+[text][id] references, so the id round trip is exercised), "canned" a fixed
+document (or --canned-file). Latency: a time to first token, a token rate and
+random jitter on both, from a --profile or set one by one. Errors: a share of
+requests fail with an HTTP status before streaming, and a share fail halfway
+through the stream with an error event.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 5338
+
+# name: (seconds to first token, tokens per second)
+PROFILES = {
+    "instant": (0.0, 100000),
+    "fast": (0.2, 1500),      # cerebras/groq on a good day
+    "typical": (0.6, 300),
+    "slow": (2.0, 60),
+    "stall": (8.0, 300),      # the first token takes ages, then it is fine
+}
+
+CANNED = """# A simplified page
+
+This is the stub model's canned answer. It has a [link][1] and a list:
+
+* one
+* two
+
+| a | b |
+| - | - |
+| 1 | 2 |
+"""
+
+TOKEN_RE = re.compile(r'\s*\S+|\s+')
+
+
+class StubSettings:
+    def __init__(self, profile="typical", ttft=None, tps=None, jitter=0.2, mode="echo",
+                 canned=CANNED, error_rate=0.0, error_status=500, midstream_error_rate=0.0,
+                 seed=None):
+        profile_ttft, profile_tps = PROFILES[profile]
+        self.ttft = profile_ttft if ttft is None else ttft
+        self.tps = profile_tps if tps is None else tps
+        self.jitter = jitter
+        self.mode = mode
+        self.canned = canned
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.midstream_error_rate = midstream_error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()  # handler threads share the generator
+        self.seen_prefixes = set()
+
+    def vary(self, value):
+        """value with up to +-jitter (a fraction) of random variation."""
+        with self.lock:
+            return max(0.0, value * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def chance(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+
+def _answer(settings, messages):
+    if settings.mode == "canned":
+        return settings.canned
+    text = messages[-1]["content"] if messages else ""
+    return text.split("Content to transform:\n", 1)[-1] + "\n"
+
+
+def _usage(settings, messages, completion_tokens):
+    prompt = sum(len(message.get("content") or "") for message in messages) // 4
+    # Imitate automatic prefix caching: a system message seen before is "cached".
+    system = messages[0].get("content", "") if messages and messages[0].get("role") == "system" else ""
+    with settings.lock:
+        cached = len(system) // 4 if system in settings.seen_prefixes else 0
+        if system:
+            settings.seen_prefixes.add(system)
+    return {"prompt_tokens": prompt, "completion_tokens": completion_tokens,
+            "total_tokens": prompt + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached}}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like a real provider
+    settings = StubSettings()
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_event(self, event):
+        self._send_chunk(f"data: {json.dumps(event)}\n\n".encode())
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [
+                {"id": "stub", "object": "model", "owned_by": "darkly"}]})
+        else:
+            self._send_json(404, {"error": {"message": f"No route {self.path}"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"No route {self.path}"}})
+            return
+        settings = self.settings
+        if settings.chance(settings.error_rate):
+            self._send_json(settings.error_status, {"error": {
+                "message": f"Injected error {settings.error_status}", "type": "stub_error"}})
+            return
+
+        messages = body.get("messages") or []
+        model = body.get("model", "stub")
+        tokens = TOKEN_RE.findall(_answer(settings, messages))
+        if body.get("max_tokens"):
+            tokens = tokens[:body["max_tokens"]]
+        finish_reason = "length" if len(tokens) < len(TOKEN_RE.findall(_answer(settings, messages))) else "stop"
+        time.sleep(settings.vary(settings.ttft))
+
+        if not body.get("stream"):
+            time.sleep(len(tokens) / settings.tps)
+            self._send_json(200, {
+                "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": finish_reason,
+                             "message": {"role": "assistant", "content": "".join(tokens)}}],
+                "usage": _usage(settings, messages, len(tokens)),
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        fail_at = None
+        if settings.chance(settings.midstream_error_rate):
+            with settings.lock:
+                fail_at = settings.random.randrange(len(tokens) or 1)
+        try:
+            for i, token in enumerate(tokens):
+                if i == fail_at:
+                    self._send_event({"error": {"message": "Injected mid-stream error", "type": "stub_error"}})
+                    break
+                self._send_event({"id": "stub", "object": "chat.completion.chunk", "model": model,
+                                  "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]})
+                time.sleep(settings.vary(1 / settings.tps))
+            else:
+                self._send_event({"id": "stub", "object": "chat.completion.chunk", "model": model,
+                                  "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    self._send_event({"id": "stub", "object": "chat.completion.chunk", "model": model,
+                                      "choices": [], "usage": _usage(settings, messages, len(tokens))})
+            self._send_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client stopped reading: that is what cancellation looks like
+
+
+def make_server(settings=None, host="127.0.0.1", port=DEFAULT_PORT):
+    """A stub server (not yet serving) using settings; port 0 picks a free port."""
+    handler = type("Handler", (StubHandler,), {"settings": settings or StubSettings()})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="typical")
+    parser.add_argument("--ttft", type=float, help="seconds to first token (overrides the profile)")
+    parser.add_argument("--tps", type=float, help="tokens per second (overrides the profile)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="random variation, as a fraction")
+    parser.add_argument("--mode", choices=("echo", "canned"), default="echo")
+    parser.add_argument("--canned-file", help="Markdown to answer with in canned mode")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests that fail up front")
+    parser.add_argument("--error-status", type=int, default=500, help="their status, e.g. 429 or 404")
+    parser.add_argument("--midstream-error-rate", type=float, default=0.0,
+                        help="share of streams that fail halfway")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    canned = CANNED
+    if args.canned_file:
+        with open(args.canned_file) as f:
+            canned = f.read()
+    settings = StubSettings(args.profile, args.ttft, args.tps, args.jitter, args.mode, canned,
+                            args.error_rate, args.error_status, args.midstream_error_rate, args.seed)
+    server = make_server(settings, args.host, args.port)
+    print(f"Stub LLM on http://{args.host}:{server.server_address[1]}/v1 "
+          f"(ttft {settings.ttft}s, {settings.tps} tokens/s, {args.mode})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,26 @@
 Run with:  python_env/bin/python test_darkly.py
 (also works under pytest if you have it)
 """
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import SimpleNamespace
 from unittest.mock import patch
 
 from bs4 import BeautifulSoup
 
-from darkly_addon import MarkdownStreamParser, dom_to_condensed
+import darkly_addon
+from darkly_addon import (MarkdownStreamParser, StreamingCondenser, _get_llm_client,
+                          close_llm_clients, dom_to_condensed)
+from darkly_admission import (PRIORITY_BACKGROUND, PRIORITY_DOCUMENT, PRIORITY_FRAME,
+                              Priority, ProviderGate)
+from darkly_cache import ResultCache, cache_key
+from darkly_router import Router
+from darkly_stub_llm import StubSettings, make_server
 from darkly_server import BlockedURL, _check_url_allowed, app
 
 MAPPING = {1: {"type": "a", "href": "/a"},
@@ -21,6 +36,27 @@ def render(md, chunk_size=10**9):
     return out + p.finish()
 
 
+@contextmanager
+def fake_model(stream, model="m", per_provider=False):
+    """The model stubbed out: `stream` stands in for _call_llm_stream or, per_provider, for
+    each provider's _stream_completion under routing and hedging. `model` is the configured
+    model name, or a function of the provider."""
+    name = model if callable(model) else lambda _provider: model
+    target = "darkly_addon._stream_completion" if per_provider else "darkly_addon._call_llm_stream"
+    with patch("darkly_addon._get_llm_client",
+               side_effect=lambda provider=None: (object(), name(provider))), \
+            patch(target, stream):
+        yield
+
+
+class HTMLPage:
+    """An origin's HTML response as fetch_page returns it. Patch iter_text for its body."""
+    headers = {"Content-Type": "text/html"}
+
+    async def aclose(self):
+        pass
+
+
 # --- dom_to_condensed -------------------------------------------------------
 
 def test_nested_blocks_keep_their_boundaries():
@@ -52,6 +88,97 @@ def test_no_blank_or_whitespace_only_lines():
     assert all(line.strip() for line in condensed.split("\n")), repr(condensed)
 
 
+def test_repeated_urls_share_one_id():
+    html = ("<body><p><a href='/x'>one</a> <a href='https://ex.com/x'>two</a>"
+            " <a href='/y'></a> <a href='/z'>three</a> <img src='/x' alt='pic'></p></body>")
+    condensed, mapping = dom_to_condensed(html, base_url="https://ex.com/")
+    assert condensed == "[one][1] [two][1] [three][2] ![pic][3]", repr(condensed)
+    assert sorted(mapping) == [1, 2, 3], mapping
+    parser = MarkdownStreamParser(mapping, "https://ex.com", "")
+    out = parser.process_chunk(condensed + "\n") + parser.finish()
+    assert out.count('href="https://ex.com/x"') == 2, out
+
+
+def test_deep_nesting_does_not_recurse():
+    html = "<body>" + "<div><span>x</span>" * 5000 + "</div>" * 5000 + "</body>"
+    condensed, _ = dom_to_condensed(html)
+    assert condensed.split("\n") == ["x"] * 5000
+
+
+def test_hint_lands_on_first_line_of_nested_content():
+    html = ("<body><nav><div> </div><div><p>Home</p><p>About</p></div></nav>"
+            "<div class='ad-slot'><span> </span></div><p>Body</p></body>")
+    condensed, _ = dom_to_condensed(html)
+    assert condensed == "(NAV) Home\nAbout\nBody", repr(condensed)
+
+
+def test_lxml_backend_matches_default():
+    try:
+        import lxml  # noqa: F401 -- optional backend
+    except ImportError:
+        return
+    html = ("<html><head><title>T</title></head><body><header class='top'>"
+            "<a href='/'>Home</a></header><article><h1>Title</h1>"
+            "<p>One <a href='/x'><img src='/i.png' alt='pic'> more</a>.</p>"
+            "<ul><li>a</li><li>b</li></ul></article></body></html>")
+    assert dom_to_condensed(html, "lxml") == dom_to_condensed(html, "html.parser")
+
+
+def test_token_budget_drops_boilerplate_before_content():
+    html = ("<body><nav><p>Home</p><p>About</p></nav>"
+            "<div class='sidebar'><p><a href='/promo'>Buy now</a></p></div>"
+            "<article><p>First paragraph.</p><p>Second paragraph.</p></article>"
+            "<footer><p>Copyright</p></footer></body>")
+    full, mapping = dom_to_condensed(html)
+    assert full.split("\n")[:3] == ["(NAV) Home", "About", "(DIV hint:sidebar) [Buy now][1]"]
+    # ~9 tokens: only the two content paragraphs fit.
+    condensed, mapping = dom_to_condensed(html, token_budget=9)
+    assert condensed == "First paragraph.\nSecond paragraph.", repr(condensed)
+    assert mapping == {}, mapping
+    condensed, _ = dom_to_condensed(html, token_budget=5)
+    assert condensed == "First paragraph.", repr(condensed)
+    assert dom_to_condensed(html, token_budget=10**6) == (full, {1: {"type": "a", "href": "/promo"}})
+
+
+def test_boilerplate_filter_drops_link_dense_blocks_outside_main_content():
+    html = ("<body><nav>" + "".join(f"<a href='/s{i}'>Section {i}</a>" for i in range(5)) + "</nav>"
+            "<article><h1>Story</h1>"
+            "<p>A paragraph with plenty of words and one <a href='/ref'>reference</a>.</p>"
+            "<p>Another paragraph that carries the actual content of the page.</p></article>"
+            "<div class='related'><p><a href='/r1'>Other story</a></p><p><a href='/r2'>More</a></p></div>"
+            "</body>")
+    assert dom_to_condensed(html, boilerplate=False)[0].startswith("(NAV) [Section 0][1]")
+    condensed, mapping = dom_to_condensed(html, boilerplate=True)
+    assert condensed.split("\n") == [
+        "Story",
+        "A paragraph with plenty of words and one [reference][6].",
+        "Another paragraph that carries the actual content of the page.",
+    ], condensed
+    assert mapping == {6: {"type": "a", "href": "/ref"}}, mapping
+
+
+def test_boilerplate_filter_keeps_an_all_links_front_page():
+    html = ("<body><table>" + "".join(
+        f"<tr><td><a href='/item{i}'>Story {i}</a></td></tr>"
+        f"<tr><td>{i} points by <a href='/u{i}'>user</a> | <a href='/c{i}'>comments</a></td></tr>"
+        for i in range(10)) + "</table></body>")
+    assert dom_to_condensed(html, boilerplate=True) == dom_to_condensed(html, boilerplate=False)
+
+
+def test_streaming_condenser_matches_dom_to_condensed():
+    html = ("<!DOCTYPE html><html><head><title>T</title></head><body>"
+            "<nav class='menu'><a href='/'>Home</a></nav><!-- c -->"
+            "<article><h1>Title &amp; more</h1><p>One <b>two</b><br>three"
+            "<img src='/i.png' alt='pic'></p><ul><li>a<li>b</ul>"
+            "<template><p>hidden</p></template><script>x = '<p>'</script>"
+            "</article></body></html>")
+    reference = dom_to_condensed(html, "html.parser")
+    for size in (1, 2, 7, 64, len(html)):
+        condenser = StreamingCondenser()
+        for i in range(0, len(html), size):
+            condenser.feed(html[i:i + size])
+        assert condenser.finish() == reference, f"differs at chunk size {size}"
+
 # --- MarkdownStreamParser ---------------------------------------------------
 
 def test_loose_list_is_one_list():
@@ -104,6 +231,18 @@ def test_image_syntax_on_link_id_becomes_link():
     assert "<img" not in out and "<a" not in out, out
 
 
+def test_nested_ids_are_restored_in_one_pass():
+    doc = ("[![pic][2] more][1] [![k](id:2)](id:1) ![l](id:1)\n\n"
+           + "".join(f"Again [x][1] ![pic][2] {i}\n\n" for i in range(5)))
+    with patch("darkly_addon.safe_url", wraps=darkly_addon.safe_url) as spy:
+        out = render(doc, 7)
+    link = '<a href="https://ex.com/a" rel="noopener noreferrer">'
+    assert f'{link}<img src="https://ex.com/i.png" alt="pic"> more</a>' in out, out
+    assert f'{link}<img src="https://ex.com/i.png" alt="k"></a>' in out, out
+    assert f'{link}l</a>' in out, out
+    assert spy.call_count == 2, spy.call_args_list  # once per id and attribute
+
+
 def test_unknown_id_is_left_alone():
     out = render("Text [x][99].\n")
     assert "[x][99]" in out, out
@@ -118,6 +257,40 @@ def test_output_is_independent_of_chunk_boundaries():
         assert render(doc, size) == reference, f"differs at chunk size {size}"
 
 
+def test_lists_and_tables_are_sent_as_their_rows_complete():
+    doc = ("".join(f"- item {i}\n\n" for i in range(12)) + "After.\n\n"
+           "| a | b |\n|---|---|\n" + "".join(f"| {i} | x |\n" for i in range(12)) + "\nEnd.\n")
+    p = MarkdownStreamParser({}, "", "")
+    pieces = [p.process_chunk(doc[i:i + 4]) for i in range(0, len(doc), 4)]
+    pieces.append(p.finish())
+    assert "".join(pieces) == render(doc)
+    first_item = next(i for i, piece in enumerate(pieces) if "<li>" in piece)
+    first_row = next(i for i, piece in enumerate(pieces) if "<td>" in piece)
+    # Sent while the rest of the construct is still arriving, not when it ends.
+    assert "</ul>" not in "".join(pieces[:first_item + 1]), pieces[first_item]
+    assert first_item < doc.index("item 3") // 4 and first_row < doc.index("| 5 |") // 4
+    # A list that turns out to be followed by a heading underline is not changed.
+    assert render("- a\n\n- b\n---\n", 1) == render("- a\n\n- b\n---\n")
+
+
+def test_each_line_is_scanned_once():
+    """A long code block or loose list must not be rescanned on every chunk."""
+    scanned = []
+    fence_re = darkly_addon.FENCE_RE
+
+    class CountingFence:
+        def match(self, line):
+            scanned.append(line)
+            return fence_re.match(line)
+
+    doc = "```\n" + "x = 1\n\n" * 200 + "```\n\n" + "".join(f"- {i}\n\n" for i in range(200))
+    with patch("darkly_addon.FENCE_RE", CountingFence()):
+        out = render(doc, 3)
+    # Once each, plus the line that opens a block again after the block before it is popped.
+    assert len(scanned) <= doc.count("\n") + 5, len(scanned)
+    assert out == render(doc), out
+
+
 def test_executable_html_is_removed():
     out = render('<script>alert(1)</script><img src="x" onerror="alert(2)">\n')
     assert "script" not in out.lower(), out
@@ -137,6 +310,467 @@ def test_mapped_attributes_cannot_break_out():
     assert "onmouseover" not in link.attrs, out
 
 
+def test_llm_clients_are_pooled_per_event_loop():
+    async def get_twice():
+        first, _ = _get_llm_client()
+        second, _ = _get_llm_client()
+        await close_llm_clients()
+        return first, second
+
+    with patch.dict(os.environ, {"AI_PROVIDER": "groq", "GROQ_API_KEY": "k"}):
+        a1, a2 = asyncio.run(get_twice())
+        b1, _ = asyncio.run(get_twice())
+    assert a1 is a2, "same loop should reuse the client"
+    assert a1 is not b1, "a client must not outlive its loop"
+    assert a1.is_closed() and b1.is_closed()
+
+
+def test_pipeline_runs_offline_against_the_stub_llm():
+    server = make_server(StubSettings("instant", jitter=0, mode="echo"), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    async def visit():
+        try:
+            return "".join([c async for c in darkly_addon.simplify_html_stream(
+                "<body><p>Offline <a href='/x'>link</a></p></body>", "https://ex.com",
+                use_cache=False)])
+        finally:
+            await close_llm_clients()
+
+    try:
+        with patch.dict(os.environ, {"AI_PROVIDER": "stub"}), \
+                patch.dict(darkly_addon.PROVIDERS, {"stub": ("STUB", base_url)}):
+            page = asyncio.run(visit())
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert "Offline" in page and 'href="https://ex.com/x"' in page, page
+
+
+def test_output_cut_off_at_max_tokens_is_not_cached():
+    server = make_server(StubSettings("instant", jitter=0, mode="echo"), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    page = "<body>" + "".join(f"<p>Paragraph {i} of a long story.</p>" for i in range(30)) + "</body>"
+
+    async def visit():
+        try:
+            return "".join([c async for c in darkly_addon.simplify_html_stream(page, "https://ex.com")])
+        finally:
+            await close_llm_clients()
+
+    try:
+        with patch.dict(os.environ, {"AI_PROVIDER": "stub"}), \
+                patch.dict(darkly_addon.PROVIDERS, {"stub": ("STUB", base_url)}), \
+                patch("darkly_addon.result_cache", ResultCache(8, "")) as cache, \
+                patch("darkly_addon.MIN_OUTPUT_TOKENS", 5):
+            with patch("darkly_addon.MAX_OUTPUT_RATIO", 0.1):
+                cut_off = asyncio.run(visit())
+                stored_cut_off = len(cache._entries)
+            whole = asyncio.run(visit())
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert "Paragraph 29" not in cut_off and "Paragraph 29" in whole, cut_off
+    assert stored_cut_off == 0 and len(cache._entries) == 1, cache._entries
+
+
+def test_result_cache_replays_until_instructions_change():
+    calls = []
+
+    async def fake_llm(_client, _model, messages, *_options):
+        calls.append(messages)
+        yield "Hello [there][1]\n"
+
+    def simplify():
+        async def collect():
+            return "".join([c async for c in darkly_addon.simplify_html_stream(
+                "<body><p>Hi <a href='/x'>there</a></p></body>", "https://ex.com")])
+        return asyncio.run(collect())
+
+    with tempfile.TemporaryDirectory() as cache_dir, \
+            fake_model(fake_llm):
+        with patch("darkly_addon.result_cache", ResultCache(8, cache_dir)):
+            first, second = simplify(), simplify()
+        assert len(calls) == 1 and first == second, calls
+        assert 'href="https://ex.com/x"' in second, second
+        # A fresh process finds the page on disk.
+        with patch("darkly_addon.result_cache", ResultCache(8, cache_dir)):
+            simplify()
+            assert len(calls) == 1, calls
+            with patch("darkly_addon.current_instructions", "Summarize."):
+                simplify()
+        assert len(calls) == 2, "changed instructions must miss"
+
+
+def test_shell_is_sent_first_and_preview_until_the_model_answers():
+    read = []
+
+    async def page():
+        read.append(True)
+        yield "<body><nav><p>Home</p></nav><p>Intro <a href='/x'>more</a> ![not md]</p>"
+        yield "<p>" + "Long body. " * 50 + "</p></body>"
+
+    async def fake_llm(_client, _model, _messages, *_options):
+        yield "# Simplified\n"
+
+    async def visit(**options):
+        read.clear()
+        stream = darkly_addon.simplify_html_stream(page(), "https://ex.com", use_cache=False, **options)
+        shell = await anext(stream)
+        assert not read and shell.rstrip().endswith('<div class="darkly-content">'), shell
+        return [chunk async for chunk in stream]
+
+    with fake_model(fake_llm), \
+            patch("darkly_addon.PREVIEW_CHARS", 40):
+        preview, hide, first, *_ = asyncio.run(visit())
+        without = asyncio.run(visit(preview=False))
+    assert preview == ('<div class="darkly-preview">\n<p>Home</p>\n'
+                       '<p>Intro more ![not md]</p>\n</div>\n'), preview
+    assert "darkly-preview { display: none; }" in hide and first.startswith("<h1>"), (hide, first)
+    assert not any("darkly-preview" in chunk for chunk in without), without
+
+
+def test_compare_runs_use_exactly_the_labelled_model():
+    import darkly_compare
+
+    seen = []
+
+    async def fake_simplify(*_args, **_options):
+        seen.append({name: getattr(darkly_addon, name) for name in darkly_compare.PINNED_SETTINGS})
+        yield "<p>x</p>"
+
+    with patch("darkly_addon.simplify_html_stream", fake_simplify), \
+            patch("darkly_addon.SIZE_RULES", [{"max_chars": 10**9, "provider": "groq"}]), \
+            patch("darkly_addon.MAX_OUTPUT_RATIO", 2.0), \
+            patch("darkly_addon.ROUTING", True), patch("darkly_addon.HEDGE_DELAY", 0.5):
+        assert asyncio.run(darkly_compare._collect("<p>x</p>", "https://ex.com")) == "<p>x</p>"
+    assert seen == [darkly_compare.PINNED_SETTINGS], seen
+
+
+def test_instructions_form_a_stable_prompt_prefix():
+    seen = []
+
+    async def fake_llm(_client, _model, messages, *_options):
+        seen.append(messages)
+        yield "ok\n"
+
+    async def visit(page):
+        return [c async for c in darkly_addon.simplify_html_stream(page, use_cache=False)]
+
+    with fake_model(fake_llm):
+        asyncio.run(visit("<body><p>One page</p></body>"))
+        asyncio.run(visit("<body><p>Another page</p></body>"))
+    (system1, user1), (system2, user2) = seen
+    assert system1 == system2 and system1["role"] == "system", system1
+    assert "One page" not in system1["content"] and "One page" in user1["content"]
+
+
+def test_size_rules_pick_the_model_and_cap_output():
+    seen = []
+
+    async def fake_llm(_client, model, _messages, provider, max_tokens, *_options):
+        seen.append((provider, model, max_tokens))
+        yield "ok\n"
+
+    async def visit(page):
+        return [c async for c in darkly_addon.simplify_html_stream(page, use_cache=False)]
+
+    rules = [{"max_chars": 100, "provider": "groq", "model": "small"},
+             {"min_ids": 3, "provider": "gemini", "max_output_ratio": 4}]
+    with patch.dict(os.environ, {"AI_PROVIDER": "cerebras"}), \
+            fake_model(fake_llm, lambda provider: f"{provider}-default"), \
+            patch("darkly_addon.SIZE_RULES", rules), \
+            patch("darkly_addon.MAX_OUTPUT_RATIO", 2):
+        asyncio.run(visit("<body><p>Short page</p></body>"))
+        links = "".join(f"<a href='/{i}'>link {i}</a> " for i in range(3))
+        asyncio.run(visit(f"<body><p>{'Long text. ' * 5000}{links}</p></body>"))
+        asyncio.run(visit(f"<body><p>{'Long text. ' * 5000}</p></body>"))
+    assert seen[0] == ("groq", "small", 1024), seen
+    assert seen[1][:2] == ("gemini", "gemini-default") and seen[1][2] > 50000, seen
+    assert seen[2][:2] == ("cerebras", "cerebras-default") and 20000 < seen[2][2] < 30000, seen
+
+
+def test_segments_regenerate_only_what_changed():
+    prompts = []
+
+    async def echo_llm(_client, _model, messages, *_options):
+        prompts.append(messages)
+        yield messages[-1]["content"].split("Content to transform:\n", 1)[1] + "\n"
+
+    def simplify(stories):
+        page = "<body>" + "".join(f"<p>{s}</p>" for s in stories) + "</body>"
+
+        async def collect():
+            return "".join([c async for c in darkly_addon.simplify_html_stream(page)])
+        return asyncio.run(collect())
+
+    stories = [f"Story {i}: something happened in place number {i * 7} today" for i in range(100)]
+    with fake_model(echo_llm), \
+            patch("darkly_addon.SEGMENT_CHARS", 400), \
+            patch("darkly_addon.result_cache", ResultCache(100, "")):
+        simplify(stories)
+        first_visit = len(prompts)
+        stories[40] = "Story 40: a different headline now"
+        out = simplify(stories)
+    assert first_visit > 5, first_visit
+    assert len(prompts) - first_visit == 1, prompts[first_visit:]
+    assert "Story 0:" in out and "a different headline" in out and "Story 99:" in out
+
+
+def test_parallel_segments_stream_in_document_order():
+    running, peak = [0], [0]
+
+    async def slow_echo_llm(_client, _model, messages, *_options):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        segment = messages[-1]["content"].split("Content to transform:\n", 1)[1]
+        # Later segments finish first, so order has to come from the merge.
+        await asyncio.sleep(0.05 / (1 + segment.count("\n")))
+        running[0] -= 1
+        yield segment + "\n"
+
+    stories = [f"Story {i}: something happened in place number {i * 7} today" for i in range(100)]
+    page = "<body>" + "".join(f"<p>{s}</p>" for s in stories) + "</body>"
+
+    async def collect():
+        return "".join([c async for c in darkly_addon.simplify_html_stream(page, use_cache=False)])
+
+    with fake_model(slow_echo_llm), \
+            patch("darkly_addon.SEGMENT_CHARS", 400), \
+            patch("darkly_addon.PARALLEL_SEGMENTS", 4):
+        out = asyncio.run(collect())
+    assert peak[0] == 4, peak
+    positions = [out.index(f"Story {i}:") for i in range(100)]
+    assert positions == sorted(positions), "segments out of order"
+
+
+def test_hedged_request_commits_to_first_content():
+    cancelled = []
+
+    async def fake_completion(_client, model, _messages, _route=None, *_options):
+        try:
+            await asyncio.sleep(1 if model == "stalls" else 0)
+        except asyncio.CancelledError:
+            cancelled.append(model)
+            raise
+        yield f"from {model}"
+
+    async def collect():
+        return [c async for c in darkly_addon._call_llm_stream(object(), "stalls", [])]
+
+    env = {"AI_PROVIDER": "cerebras", "DARKLY_BACKUP_PROVIDERS": "groq"}
+    with patch.dict(os.environ, env), \
+            fake_model(fake_completion, "fast", per_provider=True), \
+            patch("darkly_addon.HEDGE_DELAY", 0.05), \
+            patch("darkly_addon.hedge_stats", {}) as stats:
+        assert asyncio.run(collect()) == ["from fast"]
+    assert cancelled == ["stalls"], cancelled
+    assert stats == {"groq": [1, 0, 0], "cerebras": [0, 1, 0]}, stats
+
+
+def test_hedged_output_is_cached_under_the_route_that_wrote_it():
+    async def fake_completion(_client, model, _messages, _route=None, *_options):
+        await asyncio.sleep(1 if model == "stalls" else 0)
+        yield f"from {model}"
+
+    async def generate():
+        key = cache_key("text", "instructions", "cerebras/stalls")
+        return [c async for c in darkly_addon._generate_segment(
+            object(), "stalls", "instructions", "text", key, None, True, "cerebras")]
+
+    env = {"AI_PROVIDER": "cerebras", "DARKLY_BACKUP_PROVIDERS": "groq"}
+    with patch.dict(os.environ, env), \
+            fake_model(fake_completion, "fast", per_provider=True), \
+            patch("darkly_addon.HEDGE_DELAY", 0.05), \
+            patch("darkly_addon.hedge_stats", {}), \
+            patch("darkly_addon.result_cache", ResultCache(max_entries=10)) as cache:
+        assert asyncio.run(generate()) == ["from fast"]
+    assert cache.get(cache_key("text", "instructions", "groq/fast")) == "from fast"
+    assert cache.get(cache_key("text", "instructions", "cerebras/stalls")) is None
+
+
+def test_a_page_a_backup_wrote_is_replayed_on_the_next_visit():
+    calls = []
+
+    async def fake_completion(_client, model, _messages, _route=None, *_options):
+        calls.append(model)
+        await asyncio.sleep(1 if model == "stalls" else 0)
+        yield f"from {model}\n"
+
+    def visit():
+        async def collect():
+            return "".join([c async for c in darkly_addon.simplify_html_stream(
+                "<body><p>Hi</p></body>", "https://ex.com")])
+        return asyncio.run(collect())
+
+    env = {"AI_PROVIDER": "cerebras", "DARKLY_BACKUP_PROVIDERS": "groq"}
+    with patch.dict(os.environ, env), \
+            fake_model(fake_completion, lambda provider: "fast" if provider == "groq" else "stalls",
+                       per_provider=True), \
+            patch("darkly_addon.HEDGE_DELAY", 0.05), \
+            patch("darkly_addon.hedge_stats", {}), \
+            patch("darkly_addon.result_cache", ResultCache(max_entries=10)):
+        first, second = visit(), visit()
+    assert calls == ["stalls", "fast"], calls
+    assert "from fast" in second and first == second, second
+
+
+def test_identical_requests_share_one_generation():
+    calls = []
+
+    async def slow_llm(_client, _model, messages, *_options):
+        calls.append(messages)
+        for word in ["Hello ", "[there][1]", "\n\nBye.\n"]:
+            yield word
+            await asyncio.sleep(0.02)
+
+    page = "<body><p>Hi <a href='/x'>there</a></p></body>"
+
+    async def collect(prefix, delay):
+        await asyncio.sleep(delay)
+        return "".join([c async for c in darkly_addon.simplify_html_stream(page, "https://ex.com", prefix)])
+
+    async def visit():
+        # The third reader joins after the first chunks were already generated.
+        return await asyncio.gather(collect("", 0), collect("", 0), collect("/proxy?url=", 0.03))
+
+    with fake_model(slow_llm), \
+            patch("darkly_addon.result_cache", ResultCache(8, "")):
+        first, second, late = asyncio.run(visit())
+    assert len(calls) == 1, calls
+    assert first == second and "Bye." in late, late
+    assert 'href="/proxy?url=https%3A%2F%2Fex.com%2Fx"' in late, late
+
+
+def test_admission_serves_documents_before_frames_and_background():
+    order = []
+
+    async def call(gate, priority, name):
+        await gate.acquire(priority)
+        order.append(name)
+        await asyncio.sleep(0.01)
+        gate.release()
+
+    async def burst():
+        gate = ProviderGate("groq", max_concurrent=1)
+        await gate.acquire()  # a page already generating
+        calls = [asyncio.create_task(call(gate, priority, name)) for priority, name in
+                 [(PRIORITY_BACKGROUND, "prefetch"), (PRIORITY_FRAME, "frame"),
+                  (PRIORITY_DOCUMENT, "page")]]
+        await asyncio.sleep(0)
+        queued = gate.snapshot()["queued"]
+        gate.release()
+        await asyncio.gather(*calls)
+        return queued, gate.snapshot()
+
+    queued, after = asyncio.run(burst())
+    assert order == ["page", "frame", "prefetch"], order
+    assert queued == {"background": 1, "frame": 1, "document": 1}, queued
+    assert after["in_flight"] == 0 and after["admitted"] == 4, after
+
+
+def test_a_reader_joining_a_prefetch_raises_its_priority():
+    order = []
+
+    async def call(gate, priority, name):
+        await gate.acquire(priority)
+        order.append(name)
+        gate.release()
+
+    async def click_during_prefetch():
+        gate = ProviderGate("groq", max_concurrent=1)
+        await gate.acquire()  # a page already generating
+        prefetch = Priority(PRIORITY_BACKGROUND)
+        calls = [asyncio.create_task(call(gate, priority, name)) for priority, name in
+                 [(PRIORITY_FRAME, "frame"), (prefetch, "prefetch")]]
+        await asyncio.sleep(0)
+        prefetch.raise_to(PRIORITY_DOCUMENT)  # the reader clicked the link
+        gate.release()
+        await asyncio.gather(*calls)
+
+    asyncio.run(click_during_prefetch())
+    assert order == ["prefetch", "frame"], order
+
+    priorities = []
+
+    async def queued_call(_client, _model, _messages, _provider, _max_tokens, priority, _report):
+        priorities.append(priority)
+        await asyncio.sleep(0.05)
+        yield "# page"
+
+    async def read(priority):
+        return [chunk async for chunk in darkly_addon._generate_segment(
+            None, "m", "instructions", "text", "key", None, True, priority=priority)]
+
+    async def prefetch_then_click():
+        prefetching = asyncio.create_task(read(PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        return await read(PRIORITY_DOCUMENT), await prefetching
+
+    with fake_model(queued_call), \
+            patch("darkly_addon.result_cache", ResultCache(max_entries=0)):
+        assert asyncio.run(prefetch_then_click()) == (["# page"], ["# page"])
+    assert len(priorities) == 1 and priorities[0].value == PRIORITY_DOCUMENT, priorities
+
+
+def test_admission_rate_limits_requests():
+    async def two_calls():
+        gate = ProviderGate("groq", requests_per_minute=60)  # a burst of 10, then 1/s
+        gate.requests.tokens = 1
+        waits = []
+        for _ in range(2):
+            waits.append(await gate.acquire())
+            gate.release()
+        return waits
+
+    first, second = asyncio.run(two_calls())
+    assert first < 0.1 and 0.8 < second < 1.5, (first, second)
+
+
+def test_router_prefers_fast_providers_and_breaks_circuits():
+    router = Router()
+    router.record_success("slow/m", 2.0, 100)
+    router.record_success("fast/m", 0.2, 1000)
+    assert router.rank(["slow/m", "fast/m"]) == ["fast/m", "slow/m"]
+    # A retired model (404) opens the circuit at once...
+    router.record_failure("fast/m", "model not found", 404)
+    assert router.rank(["fast/m", "slow/m"]) == ["slow/m", "fast/m"]
+    assert router.due_probes(["fast/m"]) == [], "probed before its cooldown"
+    # ...other errors only when they repeat.
+    for _ in range(3):
+        router.record_failure("slow/m", "timeout")
+    assert router.is_open("slow/m")
+    with patch("darkly_router.time.time", return_value=10**12):
+        assert router.due_probes(["fast/m", "slow/m"]) == ["fast/m", "slow/m"]
+        assert router.due_probes(["fast/m"]) == [], "probed twice"
+    router.record_success("fast/m", 0.2, 1000)
+    assert not router.is_open("fast/m")
+
+
+def test_routing_fails_over_before_content_starts():
+    async def fake_completion(_client, model, _messages, route=None, *_options):
+        if model == "retired":
+            darkly_addon.router.record_failure(route, "not found", 404)
+            raise RuntimeError("404")
+        yield f"from {model}"
+
+    async def collect():
+        return [c async for c in darkly_addon._call_llm_stream(object(), "retired", [])]
+
+    env = {"AI_PROVIDER": "cerebras", "DARKLY_BACKUP_PROVIDERS": "groq"}
+    with patch.dict(os.environ, env), \
+            fake_model(fake_completion, "fine", per_provider=True), \
+            patch("darkly_addon.ROUTING", True), \
+            patch("darkly_addon.router", Router()) as router:
+        assert asyncio.run(collect()) == ["from fine"]
+        assert router.is_open("cerebras/retired")
+        # The next page goes straight to the provider that works.
+        candidates = darkly_addon._llm_candidates(object(), "retired")
+        assert [route for route, _, _ in candidates] == ["groq/fine", "cerebras/retired"]
+
+
 def test_cgnat_is_blocked():
     try:
         _check_url_allowed("http://100.100.100.200/")
@@ -145,6 +779,165 @@ def test_cgnat_is_blocked():
     raise AssertionError("CGNAT address was allowed")
 
 
+def test_origin_fetches_reuse_connections_and_check_every_hop():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import darkly_server
+
+    connections = set()
+
+    class Origin(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            connections.add(self.client_address)
+            if self.path == "/old":
+                self.send_response(302)
+                self.send_header("Location", "/new")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = "<p>café</p>".encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Origin)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    origin = f"http://127.0.0.1:{server.server_address[1]}"
+    checked = []
+
+    async def visit():
+        try:
+            texts = []
+            for _ in range(2):
+                response, url = await darkly_server.fetch_page(origin + "/old")
+                assert url == origin + "/new", url
+                texts.append("".join([text async for text in darkly_server.iter_text(response)]))
+            # One connection per host: a second fetch waits until the first response is closed.
+            first, _ = await darkly_server.fetch_page(origin + "/new")
+            second = asyncio.ensure_future(darkly_server.fetch_page(origin + "/new"))
+            await asyncio.sleep(0.1)
+            waited = not second.done()
+            await first.aread()
+            await (await second)[0].aread()
+            return texts, waited
+        finally:
+            await darkly_server.close_origin_clients()
+
+    try:
+        with patch("darkly_server._check_url_allowed", checked.append), \
+                patch("darkly_server._allowed_addresses", lambda _host, _port: ["127.0.0.1"]), \
+                patch("darkly_server.ORIGIN_PER_HOST", 1):
+            texts, waited = asyncio.run(visit())
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert texts == ["<p>café</p>"] * 2, texts
+    assert checked[:4] == [origin + "/old", origin + "/new"] * 2, checked
+    assert waited
+    assert len(connections) == 1, connections
+
+
+def test_served_pages_always_give_back_their_host_slot():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import darkly_server
+
+    class Origin(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = b"<p>x</p>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    async def gives_up(*_args, **_options):  # e.g. "Error: Unsupported model type"
+        yield "<p>Error</p>"
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Origin)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    page = f"/proxy?url=http://127.0.0.1:{server.server_address[1]}/"
+    loop = darkly_server._get_loop()
+    reset = lambda: asyncio.run_coroutine_threadsafe(darkly_server.close_origin_clients(), loop).result()
+    try:
+        with patch("darkly_server._check_url_allowed", lambda _url: None), \
+                patch("darkly_server._allowed_addresses", lambda _host, _port: ["127.0.0.1"]), \
+                patch("darkly_server.simplify_html_stream", gives_up), \
+                patch("darkly_server.ORIGIN_PER_HOST", 1), patch("darkly_server.FETCH_TIMEOUT", 1):
+            reset()
+            with app.test_client() as client:
+                client.head(page).close()
+                client.get(page).close()
+                served = client.get(page)
+                assert served.get_data(as_text=True) == "<p>Error</p>", served.status_code
+                held, _ = asyncio.run_coroutine_threadsafe(
+                    darkly_server.fetch_page(page.split("=", 1)[1]), loop).result()
+                blocked = client.get(page)
+                asyncio.run_coroutine_threadsafe(held.aclose(), loop).result()
+            assert blocked.status_code == 504, blocked.status_code
+    finally:
+        reset()
+        server.shutdown()
+        server.server_close()
+
+
+def test_dns_answers_are_cached_and_connections_go_to_the_checked_address():
+    import socket
+    import darkly_server
+
+    answers = {"site.test": ["93.184.216.34", "10.0.0.1"]}  # rebinds to a private address
+    lookups = []
+
+    def getaddrinfo(host, port, **_kwargs):
+        lookups.append(host)
+        if host not in answers:
+            raise socket.gaierror("unknown host")
+        address = answers[host].pop(0) if len(answers[host]) > 1 else answers[host][0]
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port))]
+
+    class Backend:
+        connected = []
+
+        async def connect_tcp(self, host, port, *_args):
+            self.connected.append(host)
+            return "stream"
+
+    async def connect(host):
+        return await darkly_server._PinnedBackend(Backend()).connect_tcp(host, 443)
+
+    with patch("socket.getaddrinfo", getaddrinfo), patch("darkly_server._dns_cache", OrderedDict()):
+        _check_url_allowed("https://site.test/a")
+        _check_url_allowed("https://site.test/b")
+        assert asyncio.run(connect("site.test")) == "stream"
+        for _ in range(2):
+            try:
+                _check_url_allowed("https://nowhere.test/")
+            except BlockedURL:
+                pass
+            else:
+                raise AssertionError("unresolvable host was allowed")
+        expired = (0.0, darkly_server._dns_cache["site.test"][1])
+        darkly_server._dns_cache["site.test"] = expired
+        try:
+            _check_url_allowed("https://site.test/")  # looked up again: the rebound answer
+        except BlockedURL:
+            pass
+        else:
+            raise AssertionError("private address was allowed")
+    assert lookups == ["site.test", "nowhere.test", "site.test"], lookups
+    assert Backend.connected == ["93.184.216.34"], Backend.connected
+
+
 def test_prefetch_never_reaches_the_origin():
     with patch("darkly_server.fetch_page",
                side_effect=AssertionError("fetched during a prefetch")):
@@ -155,15 +948,10 @@ def test_prefetch_never_reaches_the_origin():
 
 
 def test_html_subresource_request_is_not_simplified():
-    class Page:
-        headers = {"Content-Type": "text/html"}
-        content = b"<p>x</p>"
-        text = "<p>x</p>"
-
-    async def fake_simplify(*_args):
+    async def fake_simplify(*_args, **_kwargs):
         yield "<p>simplified</p>"
 
-    with patch("darkly_server.fetch_page", return_value=(Page(), "https://ex.com")):
+    with patch("darkly_server.fetch_page", return_value=(HTMLPage(), "https://ex.com")):
         with patch("darkly_server.simplify_html_stream", fake_simplify):
             with app.test_client() as client:
                 image = client.get("/proxy?url=https://ex.com",
@@ -175,6 +963,214 @@ def test_html_subresource_request_is_not_simplified():
     assert navigation.get_data(as_text=True) == "<p>simplified</p>"
 
 
+def test_our_result_frame_is_ranked_as_the_readers_document():
+    priorities = []
+
+    async def fake_simplify(_content, _base_url, _prefix, priority=None, **_options):
+        priorities.append(priority)
+        yield "<p>simplified</p>"
+
+    with patch("darkly_server.fetch_page", return_value=(HTMLPage(), "https://ex.com")), \
+            patch("darkly_server.iter_text", lambda _response: iter(["<p>x</p>"])), \
+            patch("darkly_server.simplify_html_stream", fake_simplify), \
+            patch("darkly_server.PREFETCH_LINKS", 0):
+        with app.test_client() as client:
+            for site in ("same-origin", "cross-site"):
+                client.get("/proxy?url=https://ex.com", headers={
+                    "Sec-Fetch-Dest": "iframe", "Sec-Fetch-Site": site}).get_data()
+    assert priorities == [PRIORITY_DOCUMENT, PRIORITY_FRAME], priorities
+
+
+def test_links_of_a_served_page_are_prefetched_in_the_background():
+    simplified = []
+
+    async def fake_simplify(_content, base_url, _prefix, priority=None, **_options):
+        simplified.append((base_url, priority))
+        yield "".join(f'<a href="/proxy?url=https%3A%2F%2Fex.com%2F{name}">{name}</a>'
+                      for name in "abc")
+
+    with patch("darkly_server.fetch_page", side_effect=lambda url: (HTMLPage(), url)), \
+            patch("darkly_server.iter_text", lambda _response: iter(["<p>x</p>"])), \
+            patch("darkly_server.simplify_html_stream", fake_simplify), \
+            patch("darkly_server.PREFETCH_LINKS", 2), \
+            patch("darkly_server._prefetched", OrderedDict()):
+        with app.test_client() as client:
+            client.get("/proxy?url=https://ex.com/").get_data()
+        for _ in range(100):
+            if len(simplified) == 3:
+                break
+            time.sleep(0.02)
+    assert simplified == [("https://ex.com/", 0), ("https://ex.com/a", 2), ("https://ex.com/b", 2)], simplified
+
+
+def test_a_prefetched_page_is_served_without_fetching_it_again():
+    import darkly_server
+
+    async def fake_simplify(_content, base_url, _prefix, **_options):
+        if base_url.endswith("/broken"):
+            yield "Error: Unsupported model type"
+            return
+        yield f"<p>{base_url} at {time.time()}</p>"  # changes on every fetch
+        yield darkly_server.PAGE_END
+
+    async def fetch(url):
+        return HTMLPage(), url + ("/" if url.endswith("redirects") else "")
+
+    with patch("darkly_server.fetch_page", fetch), \
+            patch("darkly_server.iter_text", lambda _response: iter(["<p>x</p>"])), \
+            patch("darkly_server.simplify_html_stream", fake_simplify), \
+            patch("darkly_server._prefetched_pages", OrderedDict()):
+        for url in ("https://ex.com/a", "https://ex.com/redirects", "https://ex.com/broken"):
+            asyncio.run(darkly_server._prefetch(url))
+        prefetched = darkly_server._prefetched_page("https://ex.com/a")
+        with patch("darkly_server.fetch_page", side_effect=AssertionError("fetched again")):
+            with app.test_client() as client:
+                clicked = client.get("/proxy?url=https://ex.com/a").get_data(as_text=True)
+                followed = client.get("/proxy?url=https://ex.com/redirects/").get_data(as_text=True)
+        assert darkly_server._prefetched_page("https://ex.com/broken") is None
+    assert prefetched and clicked == prefetched, clicked
+    assert "https://ex.com/redirects/ at" in followed, followed
+
+
+def test_a_prefetched_page_is_not_served_after_the_instructions_change():
+    import darkly_server
+
+    async def fake_simplify(_content, _base_url, _prefix, **_options):
+        yield f"<p>{darkly_addon.current_instructions}</p>"
+        yield darkly_server.PAGE_END
+
+    url = "https://ex.com/a"
+    with patch("darkly_server.fetch_page", side_effect=lambda url: (HTMLPage(), url)), \
+            patch("darkly_server.iter_text", lambda _response: iter(["<p>x</p>"])), \
+            patch("darkly_server.simplify_html_stream", fake_simplify), \
+            patch("darkly_server._prefetched_pages", OrderedDict()), \
+            patch("darkly_addon.current_instructions", "Simplify."):
+        asyncio.run(darkly_server._prefetch(url))
+        assert darkly_server._prefetched_page(url), "prefetched under the current instructions"
+        darkly_addon.current_instructions = "Summarize."
+        with app.test_client() as client:
+            clicked = client.get(f"/proxy?url={url}").get_data(as_text=True)
+        with patch.dict(os.environ, {"AI_PROVIDER": "stub", "STUB_MODEL": "other"}):
+            asyncio.run(darkly_server._prefetch(url))
+        stale_model = darkly_server._prefetched_page(url)
+    assert "<p>Summarize.</p>" in clicked, clicked
+    assert stale_model is None, stale_model
+
+
+def test_disconnected_reader_is_detected_while_waiting():
+    import socket
+    from darkly_server import _client_disconnected
+
+    server_end, browser_end = socket.socketpair()
+    try:
+        assert not _client_disconnected(server_end)
+        browser_end.sendall(b"GET /next HTTP/1.1\r\n")  # pipelined, still there
+        assert not _client_disconnected(server_end)
+        browser_end.close()
+        server_end.recv(100)
+        assert _client_disconnected(server_end)
+    finally:
+        server_end.close()
+
+
+def test_asgi_mode_streams_on_the_servers_loop_and_stops_for_gone_readers():
+    from darkly_server import asgi_app
+
+    cancelled = []
+
+    async def fake_simplify(_content, _base_url, _prefix, **_options):
+        yield "<p>first</p>"
+        if "slow" in _base_url:
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                cancelled.append(_base_url)
+                raise
+        yield "<p>second</p>"
+
+    async def visit(path, leave_after=None):
+        sent = []
+        left = asyncio.Event()
+
+        async def receive():
+            if not sent:
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await left.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+            if len(sent) == leave_after:
+                left.set()
+
+        path, _, query = path.partition("?")
+        scope = {"type": "http", "method": "GET", "path": path, "query_string": query.encode(),
+                 "headers": [(b"sec-fetch-dest", b"document")], "root_path": "",
+                 "scheme": "http", "server": ("testserver", 80), "http_version": "1.1"}
+        await asyncio.wait_for(asgi_app(scope, receive, send), 5)
+        return sent
+
+    with patch("darkly_server.fetch_page", side_effect=lambda url: (HTMLPage(), url)), \
+            patch("darkly_server.iter_text", lambda _response: iter(["<p>x</p>"])), \
+            patch("darkly_server.simplify_html_stream", fake_simplify):
+        served = asyncio.run(visit("/proxy?url=ex.com/fast"))
+        abandoned = asyncio.run(visit("/proxy?url=ex.com/slow", leave_after=2))
+        providers = asyncio.run(visit("/api/providers"))
+
+    assert served[0]["status"] == 200, served
+    assert b"".join(m.get("body", b"") for m in served[1:]) == b"<p>first</p><p>second</p>"
+    assert served[-1].get("more_body", False) is False
+    assert [m.get("body") for m in abandoned[1:]] == [b"<p>first</p>"], abandoned
+    assert cancelled == ["https://ex.com/slow"], cancelled
+    assert providers[0]["status"] == 200 and b"routes" in b"".join(m.get("body", b"") for m in providers[1:])
+
+
+def test_cancelled_generation_stops_the_stream_and_is_counted():
+    class Events:
+        async def iter_lines(self):
+            for i in range(1000):
+                await asyncio.sleep(0.01)
+                yield 'data: {"choices": [{"delta": {"content": "word "}}]}'
+
+    class Streaming:
+        async def __aenter__(self):
+            return Events()
+
+        async def __aexit__(self, *exc):
+            return False
+
+    responses = SimpleNamespace(create=lambda **_kwargs: Streaming())
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+        with_streaming_response=responses)))
+
+    async def drain(stream):
+        async for _ in stream:
+            pass
+
+    async def read_then_stop(reason):
+        messages = [{"role": "user", "content": "x" * 4000}]  # ~1000 tokens expected
+        reading = asyncio.create_task(drain(darkly_addon._stream_completion(
+            client, "m", messages, route="cerebras/m")))
+        await asyncio.sleep(0.1)
+        reading.cancel(reason)
+        try:
+            await reading
+        except asyncio.CancelledError:
+            pass
+
+    with patch("darkly_addon.cancel_stats", dict.fromkeys(darkly_addon.cancel_stats, 0)) as stats, \
+            patch("darkly_addon.hedge_stats", {}) as hedges, \
+            patch("darkly_addon.router", Router()):
+        asyncio.run(read_then_stop(darkly_addon.READER_GONE))
+        assert stats["cancelled"] == 1 and 0 < stats["tokens_generated"] < 20, stats
+        assert stats["tokens_saved_estimate"] == 1000 - stats["tokens_generated"], stats
+        # A hedge that lost is what hedging costs, not a saving; other cancellations count as neither.
+        asyncio.run(read_then_stop(darkly_addon.HEDGE_LOST))
+        asyncio.run(read_then_stop(None))
+    assert stats["cancelled"] == 1, stats
+    assert 1000 < hedges["cerebras"][2] < 1020, hedges
+
+
 def test_model_added_links_stay_direct():
     # Links the model injects (e.g. fact-check searches) are not proxied —
     # search engines bot-block the server-side fetch — and open in a new tab